@@ -0,0 +1,217 @@
+import json, threading, time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pymysql
+
+
+# Deterministic synthetic Mantis data shared by the fake REST server and the fake database.
+# Issue ids run from 1 to issues, every issue has notes_per_issue work notes, every new_every-th issue is new
+# (created and updated at the same time) and every attachment_every-th issue has an attachment on the issue
+# and on its first work note
+class SyntheticDataset:
+    def __init__(self, issues, notes_per_issue=3, description_kb=1, attachment_every=10, attachment_kb=64,
+                 new_every=10, updated_epoch=None):
+        self.issues = issues
+        self.notes_per_issue = notes_per_issue
+        self.description = 'x' * (description_kb * 1024)
+        self.attachment_every = attachment_every
+        self.attachment_content = b'\x89PNG' + b'\0' * max(attachment_kb * 1024 - 4, 0)
+        self.new_every = new_every
+        self.updated_epoch = updated_epoch if updated_epoch is not None else int(time.time()) - 30
+
+    @property
+    def note_count(self):
+        return self.issues * self.notes_per_issue
+
+    # Work note ids are unique across issues
+    def note_ids(self, issue_id):
+        return [issue_id * 1000 + index for index in range(self.notes_per_issue)]
+
+    # Returns the REST API /issues/{id} response of an issue
+    def issue_response(self, issue_id):
+        updated_at = _iso(self.updated_epoch)
+        is_new = self.new_every and issue_id % self.new_every == 0
+        created_at = updated_at if is_new else _iso(self.updated_epoch - 86400)
+        issue = {
+            'id': issue_id,
+            'summary': f"Synthetic issue {issue_id}",
+            'description': self.description,
+            'project': {'id': 1, 'name': 'Benchmark'},
+            'category': {'id': 1, 'name': 'General'},
+            'reporter': {'id': 1, 'name': 'reporter', 'email': 'reporter@example.com'},
+            'handler': {'id': 2, 'name': 'handler', 'email': 'handler@example.com'},
+            'status': {'id': 50, 'name': 'assigned', 'label': 'assigned'},
+            'resolution': {'id': 10, 'name': 'open', 'label': 'open'},
+            'priority': {'id': 30, 'name': 'normal', 'label': 'normal'},
+            'severity': {'id': 50, 'name': 'minor', 'label': 'minor'},
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'notes': [{
+                'id': note_id,
+                'reporter': {'id': 3, 'name': 'commenter', 'email': 'commenter@example.com'},
+                'text': f"Synthetic work note {note_id}",
+                'view_state': {'id': 10, 'name': 'public', 'label': 'public'},
+                'type': 'note',
+                'created_at': updated_at,
+                'updated_at': updated_at,
+            } for note_id in self.note_ids(issue_id)],
+        }
+        return {'issues': [issue]}
+
+    # Returns the two result sets of the GetUpdatedIssuesAndNotes procedure, every issue and note is changed
+    def changed_rows(self):
+        issue_ids = range(1, self.issues + 1)
+        issue_rows = [{'id': issue_id} for issue_id in issue_ids]
+        note_rows = [{'bug_id': issue_id, 'id': note_id} for issue_id in issue_ids
+                     for note_id in self.note_ids(issue_id)]
+        return issue_rows, note_rows
+
+    # Returns the synthetic mantis_bug_file_table metadata rows of the given issue ids
+    def attachment_rows(self, issue_ids):
+        rows = []
+        for issue_id in issue_ids:
+            if not self.attachment_every or issue_id % self.attachment_every:
+                continue
+            rows.append({'id': issue_id * 10, 'bug_id': issue_id, 'bugnote_id': 0,
+                         'filename': f"issue_{issue_id}.png"})
+            if self.notes_per_issue:
+                rows.append({'id': issue_id * 10 + 1, 'bug_id': issue_id, 'bugnote_id': issue_id * 1000,
+                             'filename': f"note_{issue_id}.png"})
+        return rows
+
+
+def _iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+# Local stand-in for the Mantis REST API serving /api/rest/issues/{id} from the dataset.
+# Every response is delayed by latency_ms to model the network and Mantis processing time
+class FakeMantisServer:
+    def __init__(self, dataset, latency_ms=0):
+        self.dataset = dataset
+        self.latency = latency_ms / 1000.0
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.__server.server_port}"
+
+    def count_request(self):
+        with self.__lock:
+            self.requests += 1
+
+    def start(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, without this keep-alive responses wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.count_request()
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    issue_id = int(self.path.split('?')[0].rstrip('/').rsplit('/', 1)[1])
+                except ValueError:
+                    issue_id = 0
+                if not 1 <= issue_id <= server.dataset.issues:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps(server.dataset.issue_response(issue_id)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='fake-mantis', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__thread.join()
+            self.__server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+# Cursor of the fake database, answering the change detection procedure and the attachment queries
+class FakeCursor:
+    def __init__(self, connection):
+        self.__connection = connection
+        self.__results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__results = []
+
+    def callproc(self, name, args=()):
+        if name != 'GetUpdatedIssuesAndNotes':
+            raise pymysql.err.ProgrammingError(f"Unknown procedure '{name}' in the fake database")
+        self.__connection.queries += 1
+        self.__results = list(self.__connection.dataset.changed_rows())
+
+    def execute(self, sql, params=()):
+        self.__connection.queries += 1
+        dataset = self.__connection.dataset
+        if sql.startswith('SELECT id, bug_id, bugnote_id, filename FROM mantis_bug_file_table'):
+            rows = dataset.attachment_rows(params)
+        elif sql.startswith('SELECT id, content FROM mantis_bug_file_table'):
+            rows = [{'id': attachment_id, 'content': dataset.attachment_content} for attachment_id in params]
+        else:
+            raise pymysql.err.NotSupportedError(f"Query not supported by the fake database: {sql[:60]}")
+        self.__results = [rows]
+
+    def fetchall(self):
+        return self.__results[0] if self.__results else ()
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+
+    def nextset(self):
+        if self.__results:
+            self.__results.pop(0)
+        return True if self.__results else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+# Stand-in for a pymysql connection to the Mantis database, backed by the synthetic dataset.
+# Only the queries of the api source are answered: change detection and the attachment table
+class FakeMysqlConnection:
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.queries = 0
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
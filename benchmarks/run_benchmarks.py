@@ -0,0 +1,227 @@
+import argparse, json, os, statistics, sys, tempfile, time, tracemalloc
+from unittest import mock
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import SyntheticDataset, FakeMantisServer, FakeMysqlConnection
+from src.config.config import read_config
+from src.core import mantis_worknotes_notification
+from src.core.mantis_worknotes_notification import MantisWorkNotesNotification
+from src.handlers.mantis_handler import MantisHandler
+from src.handlers.mysql_handler import MysqlHandler
+
+_BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'src', 'config', 'config.yaml')
+
+
+# Builds the config of one benchmark run from the repository config: Mantis points at the fake server,
+# the sink is a local file and every state file lives in the run folder, so runs never share state
+def build_config(base_config, base_url, run_dir, log_file, sink_type, outbox, coalescing, payload_format,
+                 compress_threshold):
+    config = dict(base_config)
+    config.pop('shards', None)
+    config['mantis'] = dict(config['mantis'], base_url=base_url)
+    config['cursor_file'] = os.path.join(run_dir, 'cursor.json')
+    config['attachment_base_dir'] = os.path.join(run_dir, 'attachments')
+    sink_file = 'messages.jsonl' if sink_type == 'file' else 'messages.db'
+    config['sink'] = dict(config.get('sink') or {}, type=sink_type, path=os.path.join(run_dir, sink_file))
+    config['outbox'] = dict(config.get('outbox') or {}, enabled=outbox, path=os.path.join(run_dir, 'outbox.db'))
+    config['coalescing'] = dict(config.get('coalescing') or {}, enabled=coalescing,
+                                path=os.path.join(run_dir, 'coalescing.db'))
+    config['payload'] = {'format': payload_format, 'compress_threshold': compress_threshold}
+    config['logging'] = dict(config['logging'], logging_file=log_file)
+    return config
+
+
+# Measures the time of a call and returns (result, seconds)
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+# Counts the messages delivered to the file or SQLite sink of a run
+def count_messages(config):
+    path = config['sink']['path']
+    if not os.path.exists(path):
+        return 0
+    if config['sink']['type'] == 'file':
+        with open(path, 'r', encoding='utf-8') as file:
+            return sum(1 for _ in file)
+    import sqlite3
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+# Stage 1: change detection through the GetUpdatedIssuesAndNotes procedure
+def run_change_detection(config, dataset):
+    mysql_handler = MysqlHandler(config['mysql'], config['attachment_base_dir'], config.get('attachments'))
+    try:
+        (issue_ids, _), seconds = timed(mysql_handler.get_updated_issues_ids_list, 0, dataset.updated_epoch + 1,
+                                        config['mantis']['project_id'])
+        return len(issue_ids), seconds
+    finally:
+        mysql_handler.close()
+
+
+# Stage 2: issue fetch, filtering, field extraction and attachment resolution, drained without a sink.
+# Returns the record count, the time to the first record and the total time
+def run_record_stream(config, dataset):
+    mantis_handler = MantisHandler(config)
+    try:
+        start = time.perf_counter()
+        first_record = None
+        count = 0
+        for _ in mantis_handler.stream_updated_issues_between(0, dataset.updated_epoch + 1):
+            if first_record is None:
+                first_record = time.perf_counter() - start
+            count += 1
+        return count, first_record or 0.0, time.perf_counter() - start
+    finally:
+        mantis_handler.close()
+
+
+# Stage 3: attachment lookup and download of every issue and note into an empty store
+def run_attachments(config, dataset):
+    mysql_handler = MysqlHandler(config['mysql'], config['attachment_base_dir'], config.get('attachments'))
+    keys = []
+    for issue_id in range(1, dataset.issues + 1):
+        keys.append((issue_id, None))
+        keys.extend((issue_id, note_id) for note_id in dataset.note_ids(issue_id))
+    try:
+        attachments, seconds = timed(mysql_handler.fetch_attachments_bulk, keys)
+        return sum(len(paths) for paths in attachments.values()), seconds
+    finally:
+        mysql_handler.close()
+
+
+# Stage 4: a complete notification cycle including the outbox, coalescing and the sink
+def run_cycle(config_file, config):
+    with mock.patch.object(mantis_worknotes_notification, '_config_file', config_file):
+        notification = MantisWorkNotesNotification(time_window=60)
+    _, seconds = timed(notification.mantis_worknotes_notification)
+    return count_messages(config), seconds
+
+
+# Runs a stage in a fresh run folder with its own config file
+def prepare_run(work_dir, name, base_config, base_url, log_file, args):
+    run_dir = os.path.join(work_dir, name)
+    os.makedirs(run_dir, exist_ok=True)
+    config = build_config(base_config, base_url, run_dir, log_file, args.sink, not args.no_outbox,
+                          not args.no_coalescing, args.payload_format, args.compress_threshold)
+    config_file = os.path.join(run_dir, 'config.yaml')
+    with open(config_file, 'w') as file:
+        yaml.safe_dump(config, file)
+    return config_file, config
+
+
+# Runs all stages of one scenario repeat times and reports the median of every measurement
+def run_scenario(issues, base_config, work_dir, log_file, args):
+    dataset = SyntheticDataset(issues, args.notes_per_issue, args.description_kb, args.attachment_every,
+                               args.attachment_kb)
+    samples = {}
+    with FakeMantisServer(dataset, args.latency_ms) as server, \
+            mock.patch('pymysql.connect', lambda **kwargs: FakeMysqlConnection(dataset)):
+        for repeat in range(args.repeat):
+            def fresh_run(stage):
+                return prepare_run(work_dir, f"{issues}-{repeat}-{stage}", base_config, server.base_url,
+                                   log_file, args)
+
+            _, config = fresh_run('detect')
+            changed, seconds = run_change_detection(config, dataset)
+            samples.setdefault('detect_s', []).append(seconds)
+            _, config = fresh_run('stream')
+            records, first_record, seconds = run_record_stream(config, dataset)
+            samples.setdefault('first_record_s', []).append(first_record)
+            samples.setdefault('stream_s', []).append(seconds)
+            _, config = fresh_run('attachments')
+            attachments, seconds = run_attachments(config, dataset)
+            samples.setdefault('attachments_s', []).append(seconds)
+            config_file, config = fresh_run('cycle')
+            messages, seconds = run_cycle(config_file, config)
+            samples.setdefault('cycle_s', []).append(seconds)
+            samples.setdefault('msgs_per_s', []).append(messages / seconds if seconds else 0.0)
+        if not args.no_memory:
+            # Measured in a separate cycle since tracing slows down the timed runs
+            config_file, config = prepare_run(work_dir, f"{issues}-memory", base_config, server.base_url,
+                                              log_file, args)
+            tracemalloc.start()
+            try:
+                run_cycle(config_file, config)
+                samples['peak_mb'] = [tracemalloc.get_traced_memory()[1] / (1024 * 1024)]
+            finally:
+                tracemalloc.stop()
+    result = {'issues': issues, 'notes': dataset.note_count, 'changed': changed, 'records': records,
+              'attachments': attachments, 'messages': messages}
+    result.update({name: statistics.median(values) for name, values in samples.items()})
+    return result
+
+
+# Reported columns as (name, width, format)
+_COLUMNS = [('issues', 8, 'd'), ('messages', 9, 'd'), ('detect_s', 9, '.3f'), ('first_record_s', 15, '.3f'),
+            ('stream_s', 9, '.3f'), ('attachments_s', 14, '.3f'), ('cycle_s', 9, '.3f'), ('msgs_per_s', 11, '.1f'),
+            ('peak_mb', 8, '.1f')]
+
+
+def print_header():
+    print(' '.join(f"{name:>{width}}" for name, width, _ in _COLUMNS))
+
+
+def print_result(result):
+    print(' '.join(f"{result[name]:>{width}{fmt}}" if name in result else f"{'-':>{width}}"
+                   for name, width, fmt in _COLUMNS))
+
+
+# Offline benchmark of the notification pipeline.
+# A fake Mantis REST server, a fake Mantis database with a synthetic attachment table and a local file or
+# SQLite sink stand in for Mantis, MySQL and MSMQ, so throughput can be measured reproducibly on any machine.
+# For every scenario (number of changed issues) the stages are timed separately and as a complete cycle:
+#   detect_s       change detection procedure
+#   first_record_s time until the first record leaves the streaming pipeline
+#   stream_s       issue fetch, filtering, field extraction and attachment resolution
+#   attachments_s  attachment lookup and download of all issues and notes into an empty store
+#   cycle_s        complete cycle including outbox, coalescing and sink, with msgs_per_s
+#   peak_mb        peak traced Python memory of a complete cycle
+# Usage: python benchmarks/run_benchmarks.py --issues 10 1000 10000 --latency-ms 5 --output results.json
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Mantis work-notes notification')
+    parser.add_argument('--issues', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='changed issue counts of the scenarios')
+    parser.add_argument('--notes-per-issue', type=int, default=3)
+    parser.add_argument('--description-kb', type=int, default=1)
+    parser.add_argument('--attachment-every', type=int, default=10,
+                        help='every n-th issue has an issue and a work note attachment, 0 for none')
+    parser.add_argument('--attachment-kb', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=0, help='response delay of the fake Mantis API')
+    parser.add_argument('--sink', choices=['file', 'sqlite'], default='file')
+    parser.add_argument('--payload-format', choices=['legacy', 'compact', 'grouped'], default='legacy')
+    parser.add_argument('--compress-threshold', type=int, default=0,
+                        help='compress message bodies longer than this, 0 for no compression')
+    parser.add_argument('--no-outbox', action='store_true')
+    parser.add_argument('--no-coalescing', action='store_true')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the median is reported')
+    parser.add_argument('--config', default=_BASE_CONFIG, help='config the benchmark config is derived from')
+    parser.add_argument('--work-dir', default=None, help='folder for the run state, a temporary folder by default')
+    parser.add_argument('--output', default=None, help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    base_config = read_config(args.config)
+    with tempfile.TemporaryDirectory(prefix='mantis-benchmark-') as temp_dir:
+        work_dir = os.path.abspath(args.work_dir or temp_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        log_file = os.path.join(work_dir, 'benchmark.log')
+        results = []
+        print_header()
+        for issues in args.issues:
+            results.append(run_scenario(issues, base_config, work_dir, log_file, args))
+            print_result(results[-1])
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'parameters': vars(args), 'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
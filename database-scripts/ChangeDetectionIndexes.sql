@@ -0,0 +1,4 @@
+-- Supporting indexes for GetUpdatedIssues, GetUpdatedIssuesAndNotes and the incremental cursor query.
+-- Both are range scans on the raw integer timestamp columns, so no full table scan is needed per poll.
+CREATE INDEX idx_bug_last_updated ON mantis_bug_table (last_updated, id);
+CREATE INDEX idx_bugnote_last_modified ON mantis_bugnote_table (last_modified, bug_id);
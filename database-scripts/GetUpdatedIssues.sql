@@ -4,8 +4,9 @@ CREATE DEFINER=`root`@`localhost` PROCEDURE `GetUpdatedIssues`(
     IN end_date DATETIME
 )
 BEGIN
+    -- Bounds are converted once so the raw last_updated column can use idx_bug_last_updated
     SELECT id
     FROM mantis_bug_table
-    WHERE FROM_UNIXTIME(last_updated) BETWEEN start_date AND end_date;
+    WHERE last_updated BETWEEN UNIX_TIMESTAMP(start_date) AND UNIX_TIMESTAMP(end_date);
 END$$
 DELIMITER ;
@@ -0,0 +1,25 @@
+DELIMITER $$
+CREATE DEFINER=`root`@`localhost` PROCEDURE `GetUpdatedIssuesAndNotes`(
+    IN start_epoch INT UNSIGNED,
+    IN end_epoch INT UNSIGNED,
+    IN in_project_id INT UNSIGNED
+)
+BEGIN
+    -- Result set 1: issues updated in (start_epoch, end_epoch], optionally limited to a project (0 = all)
+    SELECT id
+    FROM mantis_bug_table
+    WHERE last_updated > start_epoch
+      AND last_updated <= end_epoch
+      AND (in_project_id = 0 OR project_id = in_project_id)
+    ORDER BY last_updated, id;
+
+    -- Result set 2: work notes added or edited in the same window
+    SELECT n.bug_id, n.id
+    FROM mantis_bugnote_table n
+    JOIN mantis_bug_table b ON b.id = n.bug_id
+    WHERE n.last_modified > start_epoch
+      AND n.last_modified <= end_epoch
+      AND (in_project_id = 0 OR b.project_id = in_project_id)
+    ORDER BY n.bug_id, n.id;
+END$$
+DELIMITER ;
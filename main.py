@@ -1,13 +1,48 @@
-from src import MantisWorkNotesNotification
+import argparse
+
+from src import MantisWorkNotesNotification, run_shards
+from src.utils import to_epoch
 
 
 # Main method to trigger the process.
-# Time_window is the time in minutes window for issues/notes extraction
+# Time_window is the time in minutes window for issues/notes extraction of the first run,
+# later runs continue from the stored cursor.
+# With --service the process keeps running and starts a cycle every interval seconds.
+# With --all-shards every shard of the shards config section runs in its own worker process.
+# With --backfill-start and --backfill-end the changes of that range are replayed instead, resuming
+# an earlier interrupted backfill of the same range
 def main():
+    parser = argparse.ArgumentParser(description='Mantis work-notes notification')
+    parser.add_argument('--service', action='store_true', help='run as a long running service')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='seconds between service cycles, defaults to service.interval_seconds')
+    parser.add_argument('--shard', default=None, help='run a single shard of the shards config section')
+    parser.add_argument('--all-shards', action='store_true', help='run all configured shards in parallel')
+    parser.add_argument('--backfill-start', default=None,
+                        help='ISO 8601 start of a range to backfill, UTC unless an offset is given')
+    parser.add_argument('--backfill-end', default=None,
+                        help='ISO 8601 end of a range to backfill, UTC unless an offset is given')
+    args = parser.parse_args()
+    if args.all_shards and (args.backfill_start or args.backfill_end):
+        parser.error('--backfill-start and --backfill-end cannot be combined with --all-shards, '
+                     'backfill one shard at a time with --shard')
     try:
-        mantis_notification  = MantisWorkNotesNotification(time_window=1)
-        results = mantis_notification.mantis_worknotes_notification()
-        print(results)
+        if args.all_shards:
+            results = run_shards(time_window=1, incremental=True, service=args.service,
+                                 interval_seconds=args.interval)
+            for shard, (succeeded, msg) in results.items():
+                print(f"{shard}: {msg}")
+            return
+        mantis_notification  = MantisWorkNotesNotification(time_window=1, incremental=True, shard=args.shard)
+        if args.backfill_start or args.backfill_end:
+            if not (args.backfill_start and args.backfill_end):
+                parser.error('--backfill-start and --backfill-end must be given together')
+            print(mantis_notification.backfill(to_epoch(args.backfill_start), to_epoch(args.backfill_end)))
+        elif args.service:
+            mantis_notification.run_service(args.interval)
+        else:
+            results = mantis_notification.mantis_worknotes_notification()
+            print(results)
     except Exception as ex:
         print(ex)
 
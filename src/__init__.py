@@ -1 +1 @@
-from src.core import MantisWorkNotesNotification
+from src.core import MantisWorkNotesNotification, run_shards
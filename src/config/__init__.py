@@ -1 +1,2 @@
-from .config import MantisConfig, MysqlConfig, MsmqConfig, read_config
+from .config import MantisConfig, MysqlConfig, MsmqConfig, AttachmentConfig, SinkConfig, OutboxConfig, ServiceConfig, CoalescingConfig, BackfillConfig, MetricsConfig, LoggingConfig, PayloadConfig, read_config, list_shards, resolve_shard_config
+from .field_plan import ExtractionPlan
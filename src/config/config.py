@@ -1,4 +1,6 @@
-import yaml
+import copy, os, yaml
+
+from .field_plan import ExtractionPlan
 
 
 # Config class to hold the mandatory MySQL variables
@@ -17,6 +19,96 @@ class MsmqConfig:
         self.queue = config['queue']
 
 
+# Config class to hold the optional message sink variables
+class SinkConfig:
+    def __init__(self, config):
+        self.type = config.get('type', 'msmq')
+        self.path = config.get('path')
+        self.transactional = config.get('transactional', False)
+        self.batch_size = int(config.get('batch_size', 100))
+
+
+# Config class to hold the optional service mode variables
+class ServiceConfig:
+    def __init__(self, config):
+        self.interval_seconds = float(config.get('interval_seconds', 30))
+
+
+# Config class to hold the optional outbox variables
+class OutboxConfig:
+    def __init__(self, config):
+        self.enabled = config.get('enabled', False)
+        self.path = config.get('path', 'state/outbox.db')
+        self.max_attempts = int(config.get('max_attempts', 10))
+        self.retention_days = config.get('retention_days', 7)
+
+
+# Config class to hold the optional change coalescing variables
+class CoalescingConfig:
+    def __init__(self, config):
+        self.enabled = config.get('enabled', False)
+        self.path = config.get('path', 'state/coalescing.db')
+        self.debounce_seconds = float(config.get('debounce_seconds', 0))
+        self.retention_days = config.get('retention_days', 30)
+
+
+# Config class to hold the logging variables
+class LoggingConfig:
+    def __init__(self, config):
+        self.logging_file = config['logging_file']
+        self.logging_level = config['logging_level']
+        self.logging_format = config['logging_format']
+        self.use_queue = config.get('async', False)
+        self.json = config.get('json', False)
+        self.rotation = config.get('rotation', 'none')
+        if self.rotation not in ('none', 'size', 'time'):
+            raise ValueError(f"Unsupported log rotation '{self.rotation}', expected 'none', 'size' or 'time'")
+        self.max_bytes = int(config.get('max_bytes', 10 * 1024 * 1024))
+        self.when = config.get('when', 'midnight')
+        self.backup_count = int(config.get('backup_count', 5))
+        self.message_log = config.get('message_log', 'all')
+        if self.message_log not in ('all', 'sample', 'summary'):
+            raise ValueError(f"Unsupported message log mode '{self.message_log}', "
+                             f"expected 'all', 'sample' or 'summary'")
+        self.sample_every = max(int(config.get('sample_every', 100)), 1)
+
+
+# Config class to hold the optional message payload variables
+class PayloadConfig:
+    def __init__(self, config):
+        self.format = config.get('format', 'legacy')
+        if self.format not in ('legacy', 'compact', 'grouped'):
+            raise ValueError(f"Unsupported payload format '{self.format}', expected 'legacy', 'compact' or 'grouped'")
+        self.compress_threshold = int(config.get('compress_threshold', 0))
+
+
+# Config class to hold the optional metrics export variables
+class MetricsConfig:
+    def __init__(self, config):
+        self.enabled = config.get('enabled', False)
+        self.format = config.get('format', 'json')
+        if self.format not in ('prometheus', 'json'):
+            raise ValueError(f"Unsupported metrics format '{self.format}', expected 'prometheus' or 'json'")
+        self.path = config.get('path', 'state/metrics.json')
+        self.profile = config.get('profile', False)
+        self.profile_dir = config.get('profile_dir', 'state/profiles')
+
+
+# Config class to hold the optional backfill variables
+class BackfillConfig:
+    def __init__(self, config):
+        self.chunk_minutes = float(config.get('chunk_minutes', 60))
+        self.parallelism = int(config.get('parallelism', 4))
+        self.checkpoint_dir = config.get('checkpoint_dir', 'state/backfill')
+
+
+# Config class to hold the optional attachment store variables
+class AttachmentConfig:
+    def __init__(self, config):
+        self.convert_to_png = config.get('convert_to_png', False)
+        self.convert_workers = config.get('convert_workers')
+
+
 # Config class to hold the mandatory Mantis variables
 class MantisConfig:
     def __init__(self, config):
@@ -26,7 +118,67 @@ class MantisConfig:
         self.time_zone = config['time_zone']
         self.issue_fields = [field.strip() for field in config['issue_fields'].split(',')]
         self.work_notes_fields = [field.strip() for field in config['work_notes_fields'].split(',')]
+        # Field lists are compiled once into extraction plans which are reused for every record
+        self.issue_plan = ExtractionPlan(self.issue_fields, "Issue ")
+        self.work_notes_plan = ExtractionPlan(self.work_notes_fields, "Work Note ")
         self.page_size = config['page_size']
+        self.source = config.get('source', 'api')
+        if self.source not in ('api', 'db'):
+            raise ValueError(f"Unsupported mantis source '{self.source}', expected 'api' or 'db'")
+        self.max_workers = int(config.get('max_workers', 8))
+        self.request_timeout = config.get('request_timeout', 30)
+        self.rate_limit = float(config.get('rate_limit', 0))
+        self.stream_buffer_size = int(config.get('stream_buffer_size', 100))
+        self.stream_chunk_size = int(config.get('stream_chunk_size', 50))
+        self.max_fetch_attempts = int(config.get('max_fetch_attempts', 5))
+
+
+# Returns the names of the shards (Mantis projects or instances) configured in the shards section
+def list_shards(config):
+    return [shard['name'] for shard in config.get('shards') or []]
+
+
+# Returns the config of one shard: its section overrides are merged over the base sections and
+# its state files (cursor, outbox, coalescing store, local sink, backfill checkpoints, metrics), log file and
+# attachment store
+# are placed in a folder of their own, as attachment ids of different instances may collide and
+# shard processes must not rotate the same log file
+def resolve_shard_config(config, shard_name):
+    shards = {shard['name']: shard for shard in config.get('shards') or []}
+    if shard_name not in shards:
+        raise KeyError(f"Shard '{shard_name}' not found in the YAML file")
+    shard_config = copy.deepcopy({key: value for key, value in config.items() if key != 'shards'})
+    for section, overrides in shards[shard_name].items():
+        if section == 'name':
+            continue
+        if isinstance(overrides, dict) and isinstance(shard_config.get(section), dict):
+            shard_config[section].update(overrides)
+        else:
+            shard_config[section] = overrides
+    if 'cursor_file' not in shards[shard_name]:
+        shard_config['cursor_file'] = _shard_path(shard_config['cursor_file'], shard_name)
+    if 'attachment_base_dir' not in shards[shard_name]:
+        shard_config['attachment_base_dir'] = os.path.join(shard_config['attachment_base_dir'], shard_name)
+    for section in ('outbox', 'coalescing', 'sink'):
+        if (shard_config.get(section) or {}).get('path') and 'path' not in (shards[shard_name].get(section) or {}):
+            shard_config[section]['path'] = _shard_path(shard_config[section]['path'], shard_name)
+    if shard_config.get('backfill') and 'checkpoint_dir' not in (shards[shard_name].get('backfill') or {}):
+        shard_config['backfill']['checkpoint_dir'] = os.path.join(shard_config['backfill']['checkpoint_dir'],
+                                                                  shard_name)
+    if shard_config.get('logging') and 'logging_file' not in (shards[shard_name].get('logging') or {}):
+        shard_config['logging']['logging_file'] = _shard_path(shard_config['logging']['logging_file'], shard_name)
+    if shard_config.get('metrics'):
+        shard_metrics = shards[shard_name].get('metrics') or {}
+        if 'path' not in shard_metrics and 'path' in shard_config['metrics']:
+            shard_config['metrics']['path'] = _shard_path(shard_config['metrics']['path'], shard_name)
+        if 'profile_dir' not in shard_metrics and 'profile_dir' in shard_config['metrics']:
+            shard_config['metrics']['profile_dir'] = os.path.join(shard_config['metrics']['profile_dir'], shard_name)
+    return shard_config
+
+
+# Places a state file in a sub folder named after the shard
+def _shard_path(path, shard_name):
+    return os.path.join(os.path.dirname(path), shard_name, os.path.basename(path))
 
 
 # Reads YAML config file from given path.
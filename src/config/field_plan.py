@@ -0,0 +1,101 @@
+import re
+
+# One path segment: a field name optionally followed by a list selector, e.g. custom_fields[field.name=Team]
+_SEGMENT = re.compile(r'([^.\[\]]+)(?:\[([^=\]]+)=([^\]]*)\])?')
+_ALIAS = re.compile(r'\s+as\s+', re.IGNORECASE)
+
+
+# Parses a dotted field path into a tuple of (name, selector) steps.
+# The selector is None or a (path steps, expected value) pair used to pick one element of a list
+def parse_field_path(path):
+    steps = []
+    position = 0
+    while position < len(path):
+        match = _SEGMENT.match(path, position)
+        if not match:
+            raise ValueError(f"Invalid field path '{path}'")
+        name, selector_path, selector_value = match.groups()
+        selector = None
+        if selector_path is not None:
+            selector = (parse_field_path(selector_path.strip()), selector_value.strip())
+        steps.append((name.strip(), selector))
+        position = match.end()
+        if position < len(path):
+            if path[position] != '.':
+                raise ValueError(f"Invalid field path '{path}'")
+            position += 1
+    return tuple(steps)
+
+
+# Resolves parsed steps against a record.
+# When a list is reached without a selector the remaining steps are applied to every element
+def resolve_path(data, steps):
+    value = data
+    for index, (name, selector) in enumerate(steps):
+        if isinstance(value, list):
+            return [resolve_path(item, steps[index:]) for item in value]
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+        if selector is not None:
+            selector_steps, expected = selector
+            value = next((item for item in value or ()
+                          if str(resolve_path(item, selector_steps)) == expected), None)
+    return value
+
+
+# Builds the output key of a field the way the notification messages always named them:
+# handler/reporter fields keep their full path (handler renamed to assignee), other nested fields drop the leaf.
+# Fields picking a list element by a selector are named after the selector value
+def build_output_key(field, steps, prefix):
+    if len(steps) == 1:
+        return prefix + field.capitalize()
+    if 'handler' in field:
+        return prefix + field.replace('handler', 'assignee').capitalize()
+    if 'reporter' in field:
+        return prefix + field.capitalize()
+    selectors = [selector[1] for _, selector in steps if selector is not None]
+    if selectors:
+        return prefix + selectors[-1]
+    return prefix + '.'.join(name for name, _ in steps[:-1]).capitalize()
+
+
+# Creates the fastest accessor for the parsed steps, plain one and two level paths avoid the generic walk
+def _build_accessor(steps):
+    if all(selector is None for _, selector in steps):
+        if len(steps) == 1:
+            name = steps[0][0]
+            return lambda data: data.get(name)
+        if len(steps) == 2:
+            parent, child = steps[0][0], steps[1][0]
+
+            def nested_accessor(data):
+                value = data.get(parent)
+                if isinstance(value, dict):
+                    return value.get(child)
+                return resolve_path(data, steps)
+            return nested_accessor
+    return lambda data: resolve_path(data, steps)
+
+
+# Extraction plan compiled once from a comma separated field list.
+# Each field is a dotted path of any depth, optionally followed by "as <Output Key>",
+# and the plan is applied to single records or batches of records
+class ExtractionPlan:
+    def __init__(self, fields, prefix):
+        self.fields = []
+        for field in fields:
+            path, *alias = _ALIAS.split(field, maxsplit=1)
+            path = path.strip()
+            steps = parse_field_path(path)
+            output_key = prefix + alias[0].strip() if alias else build_output_key(path, steps, prefix)
+            self.fields.append((output_key, _build_accessor(steps)))
+
+    # Extracts the planned fields of one record
+    def extract(self, data):
+        return {output_key: accessor(data) for output_key, accessor in self.fields}
+
+    # Extracts the planned fields of a batch of records
+    def extract_batch(self, records):
+        fields = self.fields
+        return [{output_key: accessor(data) for output_key, accessor in fields} for data in records]
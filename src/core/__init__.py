@@ -1 +1,2 @@
 from .mantis_worknotes_notification import MantisWorkNotesNotification
+from .shard_runner import run_shards
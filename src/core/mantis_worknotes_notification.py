@@ -1,80 +1,438 @@
-import os, json
-from src.config.config import read_config
-from src.utils.logger import CustomLogger
-from src.handlers.msmq_handler import MsmqHandler
-from src.handlers.mantis_handler import MantisHandler
+import os, signal, threading, time
+from src.config.config import read_config, resolve_shard_config, SinkConfig, OutboxConfig, ServiceConfig, \
+    CoalescingConfig, BackfillConfig, MetricsConfig, LoggingConfig, PayloadConfig
+from src.utils.logger import CustomLogger, SentMessageLog
+from src.utils.cursor_store import CursorStore
+from src.utils.checkpoint_store import CheckpointStore
+from src.utils.metrics import metrics
+from src.utils.payload import PayloadEncoder, batched_by_issue, build_group_data, group_key, group_records
+from src.utils.pipeline import batched, bounded_interleave, ChunkFailed, CHUNK_DONE
+from src.handlers.sink_handler import create_sink
+from src.handlers.outbox_handler import OutboxHandler
+from src.handlers.coalescing_handler import CoalescingHandler
+from src.handlers.mantis_handler import MantisHandler, split_time_range
 
 _config_file = os.path.abspath('src/config/config.yaml')
 
 
 class MantisWorkNotesNotification:
-    def __init__(self, time_window=60):
+    # In incremental mode the time window is only used for the very first run,
+    # afterwards every run continues from the cursor stored in the configured cursor file.
+    # When a shard name is given the process runs for that shard of the shards config section
+    def __init__(self, time_window=60, incremental=False, shard=None):
         self.__time_window = time_window
-        self.__msmq_client = None
+        self.__incremental = incremental
+        self.__cursor_store = None
         self.__config_file = _config_file
         self.__config = read_config(self.__config_file)
-        self.__custom_logger = CustomLogger(self.__config_file).get_logger()
+        if shard is not None:
+            self.__config = resolve_shard_config(self.__config, shard)
+        self.__custom_logger = CustomLogger(self.__config_file, self.__config['logging']).get_logger()
+        logging_config = LoggingConfig(self.__config['logging'])
+        self.__message_log = SentMessageLog(self.__custom_logger, logging_config.message_log,
+                                            logging_config.sample_every)
+        self.__sink_config = SinkConfig(self.__config.get('sink') or {})
+        payload_config = PayloadConfig(self.__config.get('payload') or {})
+        self.__payload_encoder = PayloadEncoder(payload_config.format, payload_config.compress_threshold)
+        if self.__incremental:
+            self.__cursor_store = CursorStore(self.__config['cursor_file'])
+        self.__outbox = None
+        outbox_config = OutboxConfig(self.__config.get('outbox') or {})
+        if outbox_config.enabled:
+            self.__outbox = OutboxHandler(outbox_config.path, outbox_config.max_attempts,
+                                          outbox_config.retention_days)
+        self.__coalescer = None
+        coalescing_config = CoalescingConfig(self.__config.get('coalescing') or {})
+        if coalescing_config.enabled:
+            self.__coalescer = CoalescingHandler(coalescing_config.path, coalescing_config.debounce_seconds,
+                                                 coalescing_config.retention_days)
+        self.__metrics_config = MetricsConfig(self.__config.get('metrics') or {})
+        if self.__metrics_config.profile:
+            metrics.enable_profiling(self.__metrics_config.profile_dir)
+        self.__mantis_client = None
+        self.__sink = None
+        self.__cycle_lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__service_running = False
 
     # Main method of class to start the process.
+    # Outside of service mode the clients are closed again once the cycle is done
     def mantis_worknotes_notification(self):
+        try:
+            return self.__run_cycle()
+        finally:
+            if not self.__service_running:
+                self.close()
+
+    # Runs the process as a long running service.
+    # Config, HTTP session, DB connection and queue handle stay open between cycles, cycles start every
+    # interval seconds and never overlap (a late cycle skips the missed ticks), and SIGTERM/SIGINT stop the
+    # service gracefully after the running cycle. A stop event shared with other processes, e.g. by the
+    # shard runner, stops the service as well and is set by its signal handlers
+    def run_service(self, interval_seconds=None, stop_event=None):
+        if interval_seconds is None:
+            interval_seconds = ServiceConfig(self.__config.get('service') or {}).interval_seconds
+        if stop_event is not None:
+            self.__stop_event = stop_event
+        self.__install_signal_handlers()
+        self.__service_running = True
+        self.__custom_logger.info(f"Mantis work-notes notification service started, interval {interval_seconds}s")
+        try:
+            next_run = time.monotonic()
+            while not self.__stop_event.is_set():
+                try:
+                    self.__run_cycle()
+                except Exception:
+                    # Already logged by the cycle, the service keeps running and retries on the next tick
+                    pass
+                now = time.monotonic()
+                next_run += interval_seconds
+                if next_run < now:
+                    skipped = int((now - next_run) // interval_seconds) + 1
+                    self.__custom_logger.warning(f"Cycle overran the interval, skipping {skipped} cycle(s)")
+                    next_run += skipped * interval_seconds
+                self.__stop_event.wait(next_run - now)
+        finally:
+            self.__service_running = False
+            self.close()
+            self.__custom_logger.info("Mantis work-notes notification service stopped")
+
+    # Replays the changes of an explicit (start epoch, end epoch] range, e.g. for a new consumer or after a
+    # queue outage. The range is split into chunks which are fetched concurrently, each with its own Mantis client
+    # sharing the rate limit and attachment store of the process, and sent as they arrive. Chunks are checkpointed
+    # once all their messages are sent, so an interrupted backfill of the same range resumes with the chunks
+    # which are not completed yet.
+    # Backfill messages bypass coalescing and use outbox keys of their own, so earlier deliveries are not skipped
+    def backfill(self, start_epoch, end_epoch, chunk_minutes=None, parallelism=None):
+        backfill_config = BackfillConfig(self.__config.get('backfill') or {})
+        chunk_seconds = int((chunk_minutes or backfill_config.chunk_minutes) * 60)
+        parallelism = parallelism or backfill_config.parallelism
+        backfill_id = f"{start_epoch}_{end_epoch}"
+        checkpoint = CheckpointStore(os.path.join(backfill_config.checkpoint_dir, f"{backfill_id}.json"))
+        all_chunks = split_time_range(start_epoch, end_epoch, chunk_seconds)
+        chunks = [chunk for chunk in all_chunks if not checkpoint.is_completed(chunk)]
+        with self.__cycle_lock:
+            metrics.reset()
+            try:
+                self.__custom_logger.info(f"Backfill {backfill_id} started - {len(chunks)} of {len(all_chunks)} "
+                                          f"chunks to process with parallelism {parallelism}")
+                finished_chunks = []
+                failed_chunks = []
+
+                def records():
+                    mantis_client = self.__get_mantis_client()
+                    for chunk, value in bounded_interleave(
+                            lambda chunk: self.__stream_backfill_chunk(mantis_client, chunk), chunks, parallelism,
+                            self.__sink_config.batch_size):
+                        if value is CHUNK_DONE:
+                            finished_chunks.append(chunk)
+                        elif isinstance(value, ChunkFailed):
+                            metrics.error('backfill_chunk')
+                            failed_chunks.append(chunk)
+                            self.__custom_logger.error(f"Backfill chunk {chunk} failed: {value.error}")
+                        else:
+                            yield value
+
+                # A chunk is finished once all of its records were handed over, so it is completed
+                # as soon as the batch which was being filled at that point is sent
+                def checkpoint_finished_chunks(batch=None):
+                    for chunk in finished_chunks:
+                        checkpoint.mark_completed(chunk)
+                    metrics.increment('backfill_chunks_completed_total', len(finished_chunks))
+                    finished_chunks.clear()
+
+                self.__send_data_to_queue(records(), checkpoint_finished_chunks, f"backfill:{backfill_id}:", False)
+                checkpoint_finished_chunks()
+                if failed_chunks:
+                    raise Exception(f"{len(failed_chunks)} of {len(chunks)} chunks failed, "
+                                    f"rerun the same range to resume")
+                msg = f"Backfill completed - {len(chunks)} chunks processed"
+                self.__custom_logger.info(msg)
+                return msg
+            except Exception as e:
+                msg = f"Backfill {backfill_id} failed : {e}"
+                self.__custom_logger.error(msg)
+                raise Exception(msg)
+            finally:
+                self.__export_metrics()
+                if not self.__service_running:
+                    self.close()
+
+    # Streams the records of one backfill chunk on a clone of the given Mantis client.
+    # A chunk with issues which failed to fetch with a transient error fails once its other records are streamed,
+    # so it is not checkpointed and a resumed backfill retries it
+    def __stream_backfill_chunk(self, base_client, chunk):
+        mantis_client = base_client.clone()
+        failed_ids = set()
+        try:
+            yield from mantis_client.stream_updated_issues_between(*chunk, failed_ids)
+        finally:
+            mantis_client.close()
+        if failed_ids:
+            raise Exception(f"Failed to fetch issues {sorted(failed_ids)}")
+
+    # Requests a graceful stop of the service, the running cycle is completed first
+    def stop(self):
+        self.__stop_event.set()
+
+    # Closes the reused Mantis client, sink and outbox
+    def close(self):
+        if self.__mantis_client is not None:
+            self.__mantis_client.close()
+            self.__mantis_client = None
+        self.__close_sink()
+        if self.__outbox is not None:
+            self.__outbox.close()
+        if self.__coalescer is not None:
+            self.__coalescer.close()
+
+    # Stops the service on SIGTERM and SIGINT. Signal handlers can only be installed from the main thread
+    def __install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signal_name in ('SIGTERM', 'SIGINT'):
+            if hasattr(signal, signal_name):
+                signal.signal(getattr(signal, signal_name), self.__handle_stop_signal)
+
+    def __handle_stop_signal(self, signum, frame):
+        self.__custom_logger.info(f"Received signal {signum}, stopping after the running cycle")
+        self.stop()
+
+    # Returns the reused Mantis client
+    def __get_mantis_client(self):
+        if self.__mantis_client is None:
+            self.__mantis_client = MantisHandler(self.__config)
+        return self.__mantis_client
+
+    # Returns the reused sink, opened on first use
+    def __get_sink(self):
+        if self.__sink is None:
+            sink = create_sink(self.__config)
+            sink.open()
+            self.__sink = sink
+        return self.__sink
+
+    # Closes the sink, the next send opens a fresh one
+    def __close_sink(self):
+        if self.__sink is not None:
+            sink, self.__sink = self.__sink, None
+            try:
+                sink.close()
+            except Exception as e:
+                self.__custom_logger.warning(f"Error closing the sink: {e}")
+
+    # Runs one cycle, a cycle which is still running is never overlapped
+    def __run_cycle(self):
+        if not self.__cycle_lock.acquire(blocking=False):
+            msg = "Mantis work-notes notification process skipped - previous cycle still running"
+            self.__custom_logger.warning(msg)
+            return msg
+        metrics.reset()
+        start = time.perf_counter()
         try:
             self.__custom_logger.info("Mantis work-notes notification process started")
-            issues, notes = self.__get_data_from_mantis_api()
-            msg = self.__send_data_to_queue(issues, notes)
+            with metrics.timer('stage_seconds', stage='detect'):
+                records, get_cursor = self.__get_data_from_mantis_api()
+            # Includes the fetch and extract stages, which run while the records are consumed
+            with metrics.timer('stage_seconds', stage='deliver'):
+                msg = self.__send_data_to_queue(records)
+            if get_cursor is not None:
+                # The cursor only moves forward once the data is sent to the queue or stored in the outbox
+                cursor = get_cursor()
+                self.__cursor_store.save(cursor)
+                self.__custom_logger.info(f"Cursor advanced to {cursor}")
             self.__custom_logger.info("Mantis work-notes notification process ended")
+            metrics.increment('cycles_total', outcome='success')
             return msg
         except Exception as e:
+            metrics.increment('cycles_total', outcome='failure')
             msg = f"Mantis work-notes notification process failed : {e}"
             self.__custom_logger.error(msg)
             raise Exception(msg)
+        finally:
+            metrics.observe('cycle_seconds', time.perf_counter() - start)
+            self.__export_metrics()
+            self.__cycle_lock.release()
+
+    # Writes the metrics of the cycle to the configured file, a failing export never fails the cycle
+    def __export_metrics(self):
+        if not self.__metrics_config.enabled:
+            return
+        try:
+            metrics.export(self.__metrics_config.path, self.__metrics_config.format)
+        except (OSError, ValueError) as e:
+            self.__custom_logger.warning(f"Error exporting the cycle metrics: {e}")
 
     # Method to load mantis config and
-    # invoke Mantis API call using Mantis handler to fetch updated issues in given time window
+    # invoke Mantis API call using Mantis handler to fetch updated issues in given time window.
+    # Returns the stream of updated issue and work note records, which is fetched while it is consumed, and
+    # in incremental mode the function returning the cursor to store once the stream is delivered
     def __get_data_from_mantis_api(self):
         try:
             self.__custom_logger.info("Fetching data from Mantis started")
-            mantis_client = MantisHandler(self.__config)
-            issues, notes = mantis_client.fetch_recently_updated_issues(self.__time_window)
-            self.__custom_logger.info("Fetching data from Mantis completed")
-            return issues, notes
+            mantis_client = self.__get_mantis_client()
+            get_cursor = None
+            if self.__incremental:
+                records, get_cursor = mantis_client.stream_issues_since_cursor(self.__cursor_store.load(),
+                                                                               self.__time_window)
+            else:
+                records = mantis_client.stream_recently_updated_issues(self.__time_window)
+            self.__custom_logger.info("Fetching data from Mantis completed - issue details are streamed")
+            return records, get_cursor
         except Exception as e:
             msg = f"Error fetching data from Mantis API: {e}"
             self.__custom_logger.error(msg)
             raise Exception(msg)
 
-    # Method to load MSMQ config and send data to MSMQ using MSMQ handler
-    def __send_data_to_queue(self, issues, notes):
+    # Method to load the sink config and send data to the configured sink (MSMQ by default).
+    # Records are sent in batches as they arrive from the stream, so the first messages go out while later
+    # issues are still fetched. With the outbox enabled every batch is first stored durably and then drained.
+    # The sink stays open between cycles and is reopened after an error.
+    # With coalescing enabled unchanged records are dropped and rapid successive changes are merged first.
+    # on_batch_sent is called with every batch once it is sent or stored in the outbox
+    def __send_data_to_queue(self, records, on_batch_sent=None, key_prefix='', coalesce=True):
+        coalescer = self.__coalescer if coalesce else None
         try:
             self.__custom_logger.info("Sending data to MSMQ started")
-            self.__msmq_client = MsmqHandler(self.__config['msmq'])
-            if issues or notes:
-                if issues:
-                    self.__send_issues_to_queue(issues)
-                if notes:
-                    self.__send_notes_to_queue(notes)
-                self.__custom_logger.info("Sending data to MSMQ ended - Data Successfully sent to queue")
-                return "Data Successfully sent to queue"
-            else:
-                msg = "No Data available to be sent to queue"
-                self.__custom_logger.info("Sending data to MSMQ ended - No Data available to be sent to queue")
-                return msg
+            if coalescer is not None:
+                records = coalescer.coalesce(records)
+            try:
+                if self.__outbox is not None:
+                    return self.__send_data_through_outbox(records, coalescer, on_batch_sent, key_prefix)
+                return self.__send_data_directly(records, coalescer, on_batch_sent)
+            finally:
+                self.__message_log.flush()
+                if coalescer is not None:
+                    metrics.increment('coalescing_dropped_total', coalescer.dropped)
+                    metrics.increment('coalescing_held_total', coalescer.held)
+                    self.__custom_logger.info(f"Coalescing dropped {coalescer.dropped} unchanged and "
+                                              f"held back {coalescer.held} debounced messages")
+                    coalescer.purge()
         except Exception as e:
+            metrics.error('send')
+            self.__close_sink()
             msg = f"Error sending data to MSMQ: {e}"
             self.__custom_logger.error(msg)
             raise Exception(msg)
 
-    # Method to send updated issue to the queue
-    def __send_issues_to_queue(self, issues_data):
-        for issue in issues_data:
-            label = self.__config['issue_label_formatter'].format(**issue)
-            body = json.dumps(issue, indent=4)
-            self.__msmq_client.send_message(label, body)
-            self.__custom_logger.info(f"Sent issue to queue: {label}")
-
-    # Method to send updated work notes to the queue
-    def __send_notes_to_queue(self, notes_data):
-        for note in notes_data:
-            label = self.__config['note_label_formatter'].format(**note)
-            body = json.dumps(note, indent=4)
-            self.__msmq_client.send_message(label, body)
-            self.__custom_logger.info(f"Sent work note to queue: {label}")
+    # Method to send the records to the sink in batches
+    def __send_data_directly(self, records, coalescer, on_batch_sent):
+        sent = 0
+        for batch in self.__batches(records):
+            self.__send_records_to_queue(self.__get_sink(), batch)
+            self.__mark_sent(batch, coalescer, on_batch_sent)
+            sent += len(batch)
+        if sent:
+            self.__custom_logger.info("Sending data to MSMQ ended - Data Successfully sent to queue")
+            return "Data Successfully sent to queue"
+        else:
+            msg = "No Data available to be sent to queue"
+            self.__custom_logger.info("Sending data to MSMQ ended - No Data available to be sent to queue")
+            return msg
+
+    # Records the sent or durably stored records in the coalescing store and notifies the batch listener
+    def __mark_sent(self, records, coalescer, on_batch_sent):
+        if coalescer is not None:
+            coalescer.mark_sent(records)
+        if on_batch_sent is not None:
+            on_batch_sent(records)
+
+    # Method to write the cycle's messages to the outbox under their idempotency keys and drain the outbox.
+    # Grouped messages depend on which records share a batch, so their keys differ between cycles. Their
+    # records are stored as members under the record keys instead, and records which are already in the
+    # outbox on their own or as a member of an earlier group are left out of the groups.
+    # Messages left pending by earlier cycles are drained as well
+    def __send_data_through_outbox(self, records, coalescer, on_batch_sent, key_prefix):
+        added, delivered, failed, sink_down = 0, 0, 0, False
+        for batch in self.__batches(records):
+            new_records = batch
+            if self.__payload_encoder.grouped:
+                known = self.__outbox.known_keys(key_prefix + record.key for record in batch)
+                new_records = [record for record in batch if key_prefix + record.key not in known]
+            with metrics.profiled('build'):
+                messages = self.__build_messages(new_records, key_prefix)
+            members = [(member_key, key) for key, _, _, _, member_keys in messages for member_key in member_keys]
+            with metrics.timer('stage_seconds', stage='outbox_enqueue'):
+                added += self.__outbox.enqueue([(key, label, body) for key, _, label, body, _ in messages], members)
+            self.__mark_sent(batch, coalescer, on_batch_sent)
+            # Once a whole batch failed the sink is most likely unavailable, the rest is only stored in the outbox
+            if not sink_down:
+                delivered, failed, sink_down = self.__drain_outbox(delivered, failed)
+        self.__custom_logger.info(f"Written {added} new messages to the outbox")
+        if not sink_down:
+            delivered, failed, sink_down = self.__drain_outbox(delivered, failed)
+        if sink_down:
+            self.__close_sink()
+        self.__outbox.purge_delivered()
+        retryable, exhausted = self.__outbox.count_pending()
+        metrics.increment('outbox_added_total', added)
+        metrics.increment('outbox_delivered_total', delivered)
+        metrics.increment('outbox_failed_total', failed)
+        metrics.increment('outbox_pending', retryable, state='retryable')
+        metrics.increment('outbox_pending', exhausted, state='exhausted')
+        if exhausted:
+            self.__custom_logger.error(f"{exhausted} messages in the outbox exceeded the maximum delivery attempts")
+        if failed:
+            msg = f"{delivered} messages sent to queue, {failed} failed and {retryable} are pending retry"
+            self.__custom_logger.error(f"Sending data to MSMQ ended - {msg}")
+            return msg
+        if delivered:
+            self.__custom_logger.info("Sending data to MSMQ ended - Data Successfully sent to queue")
+            return "Data Successfully sent to queue"
+        msg = "No Data available to be sent to queue"
+        self.__custom_logger.info("Sending data to MSMQ ended - No Data available to be sent to queue")
+        return msg
+
+    # Splits the records into sink batches. In the grouped format a batch holds the records of up to batch_size
+    # issues, so the records of an issue are sent as one message even when they cross a batch boundary
+    def __batches(self, records):
+        if self.__payload_encoder.grouped:
+            return batched_by_issue(records, self.__sink_config.batch_size)
+        return batched(records, self.__sink_config.batch_size)
+
+    # Drains the outbox to the sink and adds the delivered and failed messages to the given counts.
+    # Returns the counts and whether the sink failed a whole batch
+    def __drain_outbox(self, delivered, failed):
+        batch_delivered, batch_failed, sink_down = self.__outbox.drain(self.__get_sink(), self.__sink_config.batch_size,
+                                                                       self.__log_sent_labels)
+        return delivered + batch_delivered, failed + batch_failed, sink_down
+
+    # Logs the labels of messages sent from the outbox
+    def __log_sent_labels(self, labels):
+        for label in labels:
+            self.__message_log.sent("message", label)
+
+    # Builds the (label, body) message of an issue or work note record
+    def __build_message(self, record):
+        if record.kind == 'issue':
+            label = self.__config['issue_label_formatter'].format(**record.data)
+        else:
+            label = self.__config['note_label_formatter'].format(**record.data)
+        return label, self.__payload_encoder.encode(record.data)
+
+    # Builds the (key, kind, label, body, member keys) messages of a batch of records in the configured payload
+    # format. The grouped format sends the records of an issue within the batch as one message,
+    # labelled like an issue, with the issue fields stored once and the work notes in a list, and with the keys
+    # of its records as member keys. Messages of a single record have no member keys
+    def __build_messages(self, records, key_prefix=''):
+        compressed = self.__payload_encoder.compressed
+        if not self.__payload_encoder.grouped:
+            messages = [(key_prefix + record.key, "issue" if record.kind == 'issue' else "work note")
+                        + self.__build_message(record) + ((),) for record in records]
+        else:
+            messages = []
+            for group in group_records(records):
+                data = build_group_data(group)
+                label = self.__config['issue_label_formatter'].format(**data)
+                messages.append((key_prefix + group_key(group), "issue with work notes", label,
+                                 self.__payload_encoder.encode(data), [key_prefix + record.key for record in group]))
+        metrics.increment('payload_compressed_total', self.__payload_encoder.compressed - compressed)
+        return messages
+
+    # Method to send a batch of updated issues and work notes to the queue
+    def __send_records_to_queue(self, sink, records):
+        with metrics.profiled('build'):
+            messages = self.__build_messages(records)
+        sink.send_batch([(label, body) for _, _, label, body, _ in messages])
+        for _, kind, label, _, _ in messages:
+            self.__message_log.sent(kind, label)
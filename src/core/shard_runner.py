@@ -0,0 +1,75 @@
+import multiprocessing, os, signal, threading
+from concurrent.futures import ProcessPoolExecutor
+
+from src.config.config import read_config, list_shards
+from src.core.mantis_worknotes_notification import MantisWorkNotesNotification, _config_file
+
+# Stop event shared by the parent and the worker processes, set in the workers by the pool initializer
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+# Runs one shard inside a worker process and returns its outcome instead of raising,
+# so a failing shard never affects the others
+def _run_shard(shard, time_window, incremental, service, interval_seconds):
+    try:
+        mantis_notification = MantisWorkNotesNotification(time_window, incremental, shard)
+        if service:
+            mantis_notification.run_service(interval_seconds, _stop_event)
+            return shard, True, "Service stopped"
+        return shard, True, mantis_notification.mantis_worknotes_notification()
+    except Exception as e:
+        return shard, False, str(e)
+
+
+# Sets the stop event on SIGTERM and SIGINT in the parent process while the shard services run.
+# Returns the previous handlers, signal handlers can only be installed from the main thread
+def _install_stop_handlers(stop_event):
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+    previous = {}
+    for signal_name in ('SIGTERM', 'SIGINT'):
+        if hasattr(signal, signal_name):
+            signum = getattr(signal, signal_name)
+            previous[signum] = signal.signal(signum, lambda *args: stop_event.set())
+    return previous
+
+
+# Runs every configured shard (Mantis project or instance) in parallel worker processes.
+# Each shard has its own clients, cursor, outbox and rate limit.
+# In service mode SIGTERM/SIGINT of the parent stop every shard service after its running cycle
+# through a shared stop event, and the parent waits for the workers to exit. interval_seconds overrides the
+# service interval of every shard.
+# Returns a dictionary of shard name to (succeeded, result message)
+def run_shards(time_window=60, incremental=False, service=False, max_workers=None, interval_seconds=None):
+    config = read_config(_config_file)
+    shards = list_shards(config)
+    if not shards:
+        raise Exception("No shards configured in the YAML file")
+    if max_workers is None:
+        max_workers = config.get('shard_workers') or os.cpu_count()
+    # Service shards run until they are stopped, so each of them needs a worker process of its own
+    max_workers = len(shards) if service else min(max_workers, len(shards))
+    stop_event = multiprocessing.Event()
+    previous_handlers = _install_stop_handlers(stop_event) if service else {}
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(stop_event,)) as executor:
+            futures = {shard: executor.submit(_run_shard, shard, time_window, incremental, service, interval_seconds)
+                       for shard in shards}
+            for shard, future in futures.items():
+                try:
+                    _, succeeded, msg = future.result()
+                except Exception as e:
+                    # The worker process itself died
+                    succeeded, msg = False, f"Shard worker failed: {e}"
+                results[shard] = (succeeded, msg)
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    return results
@@ -1,3 +1,7 @@
 from .mysql_handler import MysqlHandler
 from .mantis_handler import MantisHandler
 from .msmq_handler import MsmqHandler
+from .sink_handler import MessageSink, SinkBatchError, create_sink
+from .local_sink_handler import FileSinkHandler, SqliteSinkHandler
+from .outbox_handler import OutboxHandler
+from .coalescing_handler import CoalescingHandler
@@ -0,0 +1,114 @@
+import hashlib, json, os, sqlite3, time
+
+from src.handlers.mantis_handler import NotificationRecord
+
+
+# Identity of the issue or work note a record describes, shared by every version of it
+def record_identity(record):
+    return f"{record.kind}:{record.issue_id}:{record.note_id or 0}"
+
+
+# Fingerprint of the extracted fields of a record
+def record_fingerprint(record):
+    content = json.dumps(record.data, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Change coalescing stage between the Mantis handler and the sink, backed by a local SQLite store.
+# A record whose extracted fields equal the last sent version is dropped. A change arriving within the
+# debounce interval after the last send is held back and merged with later changes into a single message,
+# which is released once the interval has passed
+class CoalescingHandler:
+    def __init__(self, file_path, debounce_seconds=0, retention_days=30):
+        self.__file_path = os.path.abspath(file_path)
+        self.__debounce_seconds = debounce_seconds
+        self.__retention_days = retention_days
+        self.__connection = None
+        self.dropped = 0
+        self.held = 0
+
+    # Opens the store and creates its tables if needed
+    def __get_connection(self):
+        if self.__connection is None:
+            os.makedirs(os.path.dirname(self.__file_path), exist_ok=True)
+            connection = sqlite3.connect(self.__file_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS fingerprints ("
+                               "identity TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, sent_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS held ("
+                               "identity TEXT PRIMARY KEY, kind TEXT NOT NULL, issue_id INTEGER NOT NULL, "
+                               "note_id INTEGER, updated_at TEXT NOT NULL, data TEXT NOT NULL, "
+                               "due_at REAL NOT NULL)")
+            connection.commit()
+            self.__connection = connection
+        return self.__connection
+
+    # Closes the store
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    # Method to coalesce a record stream. Yields the records to send, followed by held records which are due
+    def coalesce(self, records):
+        connection = self.__get_connection()
+        self.dropped, self.held = 0, 0
+        for record in records:
+            identity = record_identity(record)
+            fingerprint = record_fingerprint(record)
+            row = connection.execute("SELECT fingerprint, sent_at FROM fingerprints WHERE identity = ?",
+                                     (identity,)).fetchone()
+            is_held = connection.execute("SELECT 1 FROM held WHERE identity = ?", (identity,)).fetchone()
+            if row and row[0] == fingerprint:
+                # Nothing which is sent changed, a held version reverted in the meantime is dropped as well
+                if is_held:
+                    self.__release(connection, identity)
+                self.dropped += 1
+                continue
+            if is_held or (row and time.time() - row[1] < self.__debounce_seconds):
+                self.__hold(connection, identity, record, row[1] + self.__debounce_seconds if row else time.time())
+                self.held += 1
+                continue
+            yield record
+        yield from self.__due_records(connection)
+
+    # Stores or replaces the held version of a record, keeping the release time of an already held version
+    def __hold(self, connection, identity, record, due_at):
+        with connection:
+            connection.execute("INSERT INTO held (identity, kind, issue_id, note_id, updated_at, data, due_at) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                               "ON CONFLICT(identity) DO UPDATE SET updated_at = excluded.updated_at, "
+                               "data = excluded.data",
+                               (identity, record.kind, record.issue_id, record.note_id, record.updated_at,
+                                json.dumps(record.data, default=str), due_at))
+
+    def __release(self, connection, identity):
+        with connection:
+            connection.execute("DELETE FROM held WHERE identity = ?", (identity,))
+
+    # Yields the held records whose debounce interval has passed
+    def __due_records(self, connection):
+        rows = connection.execute("SELECT kind, issue_id, note_id, updated_at, data FROM held "
+                                  "WHERE due_at <= ? ORDER BY due_at", (time.time(),)).fetchall()
+        for kind, issue_id, note_id, updated_at, data in rows:
+            yield NotificationRecord(kind, issue_id, note_id, updated_at, json.loads(data))
+
+    # Method to record the records as sent, so later unchanged versions are dropped and
+    # released held versions are removed
+    def mark_sent(self, records):
+        connection = self.__get_connection()
+        sent_at = time.time()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO fingerprints (identity, fingerprint, sent_at) "
+                                   "VALUES (?, ?, ?)",
+                                   [(record_identity(record), record_fingerprint(record), sent_at)
+                                    for record in records])
+            connection.executemany("DELETE FROM held WHERE identity = ? AND updated_at = ?",
+                                   [(record_identity(record), record.updated_at) for record in records])
+
+    # Method to remove fingerprints which were not refreshed within the retention period
+    def purge(self):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute("DELETE FROM fingerprints WHERE sent_at < ?",
+                               (time.time() - self.__retention_days * 86400,))
@@ -0,0 +1,80 @@
+import json, os, sqlite3, time
+
+from src.handlers.sink_handler import MessageSink, record_sent_messages
+from src.utils.metrics import metrics
+
+
+# Sink appending every message as a JSON line to a local file
+class FileSinkHandler(MessageSink):
+    def __init__(self, file_path):
+        self.__file_path = os.path.abspath(file_path)
+        self.__file = None
+
+    # Opens the file in append mode for the whole cycle
+    def open(self):
+        if self.__file is None:
+            os.makedirs(os.path.dirname(self.__file_path), exist_ok=True)
+            self.__file = open(self.__file_path, 'a', encoding='utf-8')
+
+    # Flushes and closes the file
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    # Method to send messages to the file
+    def send_message(self, label, body):
+        self.send_batch([(label, body)])
+
+    # Method to send a batch of messages to the file with a single write
+    def send_batch(self, messages):
+        try:
+            self.open()
+            with metrics.timer('sink_send_seconds', sink='file'):
+                lines = [json.dumps({'label': label, 'body': body}) + '\n' for label, body in messages]
+                self.__file.write(''.join(lines))
+                self.__file.flush()
+            record_sent_messages('file', messages)
+        except (OSError, TypeError) as e:
+            metrics.error('sink')
+            raise Exception(f"Error sending message to file sink: {e}")
+
+
+# Sink storing every message as a row of a local SQLite database
+class SqliteSinkHandler(MessageSink):
+    def __init__(self, file_path):
+        self.__file_path = os.path.abspath(file_path)
+        self.__connection = None
+
+    # Opens the database connection for the whole cycle and creates the messages table if needed
+    def open(self):
+        if self.__connection is None:
+            os.makedirs(os.path.dirname(self.__file_path), exist_ok=True)
+            self.__connection = sqlite3.connect(self.__file_path)
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS messages ("
+                                      "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                      "label TEXT NOT NULL, body TEXT NOT NULL, sent_at REAL NOT NULL)")
+            self.__connection.commit()
+
+    # Closes the database connection
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    # Method to send messages to the database
+    def send_message(self, label, body):
+        self.send_batch([(label, body)])
+
+    # Method to send a batch of messages to the database in a single transaction
+    def send_batch(self, messages):
+        try:
+            self.open()
+            sent_at = time.time()
+            with metrics.timer('sink_send_seconds', sink='sqlite'), self.__connection:
+                self.__connection.executemany("INSERT INTO messages (label, body, sent_at) VALUES (?, ?, ?)",
+                                              [(label, body, sent_at) for label, body in messages])
+            record_sent_messages('sqlite', messages)
+        except sqlite3.Error as e:
+            metrics.error('sink')
+            raise Exception(f"Error sending message to SQLite sink: {e}")
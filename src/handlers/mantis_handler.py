@@ -1,75 +1,161 @@
-import pytz, requests
-from datetime import datetime, timedelta, timezone
+import logging, requests, time
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
 
 from src.config.config import MantisConfig
 from src.handlers.mysql_handler import MysqlHandler
+from src.utils.metrics import metrics
+from src.utils.pipeline import batched, bounded_map, bounded_prefetch
+from src.utils.rate_limiter import RateLimiter
+from src.utils.time_utils import to_epoch
 
+_logger = logging.getLogger(__name__)
 
-# Method to return time window range for the specified time zone and minutes interval
-def get_time_range(time_zone, minutes):
-    current_utc_time = datetime.now(timezone.utc)
-    target_timezone = pytz.timezone(time_zone)
-    local_datetime = current_utc_time.astimezone(target_timezone)
-    timestamp_from = local_datetime - timedelta(minutes=minutes)
-    timestamp_from = datetime.strftime(timestamp_from, "%Y-%m-%d %H:%M:%S")
-    timestamp_to = datetime.strftime(local_datetime, "%Y-%m-%d %H:%M:%S")
-    return timestamp_from, timestamp_to
 
+# Method to return time window range as UTC epoch values for the minutes interval
+def get_time_range(minutes):
+    epoch_to = int(time.time())
+    return epoch_to - minutes * 60, epoch_to
 
-# Method to verify if a given issue or work note is updated after start timestamp value
-def is_recently_updated(data, timestamp_from):
+
+# Method to split the (start epoch, end epoch] range into consecutive chunks of at most chunk_seconds
+def split_time_range(start_epoch, end_epoch, chunk_seconds):
+    if chunk_seconds <= 0:
+        raise ValueError(f"Chunks must be at least one second long, got {chunk_seconds} seconds")
+    chunks = []
+    chunk_start = start_epoch
+    while chunk_start < end_epoch:
+        chunk_end = min(chunk_start + chunk_seconds, end_epoch)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+# Method to verify if a given issue or work note is updated after the start epoch value
+# and, when an end epoch is given, not after the end epoch value.
+# Timestamps without an offset are read in the given time zone
+def is_recently_updated(data, epoch_from, epoch_to=None, time_zone='UTC'):
     try:
         # Parse issue's last updated timestamp
-        last_updated = data["updated_at"]
-        last_updated = datetime.fromisoformat(last_updated)
-        last_updated = datetime.strftime(last_updated, "%Y-%m-%d %H:%M:%S")
-        # Check if the issue was updated after timestamp_from
-        return last_updated > timestamp_from
+        last_updated = to_epoch(data["updated_at"], time_zone)
+        # Check if the issue was updated after epoch_from
+        return last_updated > epoch_from and (epoch_to is None or last_updated <= epoch_to)
     except Exception as e:
         msg = f"Failed to parse issue last updated time: {e}"
         raise Exception(msg)
 
 
 # Method to verify if a given issue is a new issue or not
-def is_new_issue(created_at, updated_at):
+def is_new_issue(created_at, updated_at, time_zone='UTC'):
     try:
-        formatted_created_at = datetime.fromisoformat(created_at)
-        formatted_created_at = datetime.strftime(formatted_created_at, "%Y-%m-%d %H:%M:%S")
-        formatted_updated_at = datetime.fromisoformat(updated_at)
-        formatted_updated_at = datetime.strftime(formatted_updated_at, "%Y-%m-%d %H:%M:%S")
-        return formatted_created_at == formatted_updated_at
+        return to_epoch(created_at, time_zone) == to_epoch(updated_at, time_zone)
     except Exception as e:
         msg = f"Failed to parse create and update date timestamps: {e}"
         raise Exception(msg)
 
 
 # Method to extract data fields from Mantis issue which are to be pushed to MSMQ.
-# Fields to extract are supplied in yaml with comma separation
-def extract_fields(data, fields_to_extract, prefix):
-    issue_data = {}
-    for field in fields_to_extract:
-        if '.' in field:
-            field_name = field.split('.')[0]
-            nested_field = field.split('.')[1]
-            value = data.get(field_name, {}).get(nested_field)
-            # Replace 'handler' with 'assignee'
-            if 'handler' in field:
-                field = field.replace('handler', 'assignee')
-                issue_data[prefix + field.capitalize()] = value
-            elif 'reporter' in field:
-                issue_data[prefix + field.capitalize()] = value
-            else:
-                issue_data[prefix + field_name.capitalize()] = value
+# Fields to extract are supplied in yaml with comma separation and compiled once into an extraction plan
+def extract_fields(data, plan):
+    return plan.extract(data)
+
+
+# Extracted issue or work note ready to be sent, together with the identity of the change it describes
+class NotificationRecord(namedtuple('NotificationRecord', ['kind', 'issue_id', 'note_id', 'updated_at', 'data'])):
+    __slots__ = ()
+
+    # Deterministic key of the change, identical for every cycle which sees the same change
+    @property
+    def key(self):
+        return f"{self.kind}:{self.issue_id}:{self.note_id or 0}:{self.updated_at}"
+
+
+# Method to split a record stream into the lists of issue records and work note records
+def split_records(records):
+    issues, notes = [], []
+    for record in records:
+        (issues if record.kind == 'issue' else notes).append(record)
+    return issues, notes
+
+
+# Method to compute the cursor after a read of the given rows, which covered every second before the upper bound
+def next_cursor(cursor, rows, upper_bound):
+    last_updated = upper_bound - 1
+    if last_updated < cursor['last_updated']:
+        return cursor
+    issue_ids = [row['id'] for row in rows if row['last_updated'] == last_updated]
+    if last_updated == cursor['last_updated']:
+        issue_ids.append(cursor['issue_id'])
+    return {'last_updated': last_updated, 'issue_id': max(issue_ids, default=0)}
+
+
+# Method to tell if a failed issue fetch may succeed when it is retried: timeouts, connection errors, 429 and 5xx.
+# Other 4xx responses, e.g. a private issue the token cannot see, and invalid responses are permanent
+def is_transient_error(error):
+    if isinstance(error, (ValueError, KeyError)):
+        return False
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+
+# Method to count the fetch attempts of the issues which failed with a transient error, continuing the counts
+# recorded in the cursor. Issues which reached max_attempts are given up and logged.
+# Returns the attempt counts by issue id (as a string) of the issues which hold the cursor
+def count_fetch_attempts(cursor, failed_ids, max_attempts):
+    attempts = {}
+    for issue_id in sorted(failed_ids):
+        count = cursor.get('attempts', {}).get(str(issue_id), 0) + 1
+        if count >= max_attempts:
+            metrics.increment('issues_skipped_total')
+            _logger.error(f"Skipping issue {issue_id} after {count} failed fetch attempts")
         else:
-            value = data.get(field)
-            issue_data[prefix + field.capitalize()] = value
-    return issue_data
+            attempts[str(issue_id)] = count
+    return attempts
+
+
+# Method to lower the upper bound of a cursor read to the earliest change of the issues which failed to fetch,
+# so the next cursor stays before them and the next cycle fetches them again.
+# Issue rows carry last_updated and note rows last_modified
+def retry_upper_bound(failed_ids, issue_rows, note_rows, upper_bound):
+    change_times = [row['last_updated'] for row in issue_rows if row['id'] in failed_ids]
+    change_times.extend(row['last_modified'] for row in note_rows if row['bug_id'] in failed_ids)
+    return min(change_times + [upper_bound])
 
 
 class MantisHandler:
-    def __init__(self, config):
+    # A rate limiter and attachment store can be given to share them with other clients of the process
+    def __init__(self, config, rate_limiter=None, attachment_store=None):
+        self.__config = config
         self.__mantis_config = MantisConfig(config['mantis'])
-        self.__mysql_handler = MysqlHandler(config['mysql'], config['attachment_base_dir'])
+        self.__mysql_handler = MysqlHandler(config['mysql'], config['attachment_base_dir'],
+                                            config.get('attachments'), attachment_store)
+        self.__session = None
+        self.__rate_limiter = rate_limiter or RateLimiter(self.__mantis_config.rate_limit)
+
+    # Returns a new client with its own HTTP session and database connection, which shares the rate limiter
+    # and attachment store of this client, so concurrent clients stay within one rate limit and one index
+    def clone(self):
+        return MantisHandler(self.__config, self.__rate_limiter, self.__mysql_handler.attachment_store)
+
+    # Returns the shared keep-alive HTTP session, sized for the configured number of fetch workers
+    def __get_session(self):
+        if self.__session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__mantis_config.max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(self.__setup_header())
+            session.params = self.__setup_params()
+            self.__session = session
+        return self.__session
+
+    # Closes the shared HTTP session and database connection, a shared attachment store is closed by its owner
+    def close(self):
+        if self.__session is not None:
+            self.__session.close()
+            self.__session = None
+        self.__mysql_handler.close()
 
     # Sets up the header for Mantis API call
     def __setup_header(self):
@@ -88,72 +174,190 @@ class MantisHandler:
         }
         return params
 
-    # Method to download the attachment for the given bug id or bug note id & gets the location of downloaded files
-    def __get_attachment_details(self, bug_id, bug_note_id=None):
+    # Method to download the attachments for all the given (bug id, bug note id) keys in one go &
+    # gets the location of downloaded files per key
+    def __get_attachment_details(self, keys):
         try:
-            return self.__mysql_handler.fetch_attachments(bug_id, bug_note_id)
+            return self.__mysql_handler.fetch_attachments_bulk(keys)
         except Exception as e:
             msg = f"Failed to download the attachments for the ticket/worknotes: {e}"
             raise Exception(msg)
 
-    # Method to fetch the updated issues ids from Mantis DB and
-    # then fetch issues details for the retrieved issues ids using Mantis API
-    def __fetch_updated_issues_between_range(self, issues_ids_list):
+    # Method to fetch the issue details from the configured source as a stream in the order of the ids.
+    # The db source reads issues and notes in chunks with a few bulk queries instead of one API call per issue
+    # Ids of issues which failed to fetch are added to failed_ids
+    def __iter_issues(self, issues_ids_list, changed_notes=None, failed_ids=None):
+        if self.__mantis_config.source == 'db':
+            for chunk in batched(issues_ids_list, self.__mantis_config.stream_chunk_size):
+                chunk_notes = None
+                if changed_notes is not None:
+                    # Only the changed notes of the chunk, so each query reads the notes of its own issues
+                    chunk_notes = {issue_id: changed_notes[issue_id] for issue_id in chunk if issue_id in changed_notes}
+                yield from self.__mysql_handler.fetch_issues(chunk, self.__mantis_config.time_zone, chunk_notes)
+        else:
+            yield from self.__fetch_updated_issues_between_range(issues_ids_list, failed_ids)
+
+    # Method to fetch issues details for the retrieved issues ids using Mantis API.
+    # Issues are fetched concurrently on the shared session with a bounded number of requests in flight
+    # and yielded in the order of the ids. An issue which fails or comes back empty is logged and skipped
+    # without affecting the others, the ids of issues which failed with a transient error are added to failed_ids
+    # when it is given
+    def __fetch_updated_issues_between_range(self, issues_ids_list, failed_ids=None):
+        if not issues_ids_list:
+            return
+        workers = min(self.__mantis_config.max_workers, len(issues_ids_list))
+        for issue_id, issues, error in bounded_map(self.__fetch_issue, issues_ids_list, workers, workers * 2):
+            if error is not None:
+                metrics.error('mantis_api')
+                if failed_ids is not None and is_transient_error(error):
+                    failed_ids.add(issue_id)
+                _logger.error(f"Failed in Mantis API Call for issue {issue_id}: {error}")
+            elif not issues:
+                _logger.warning(f"Mantis API returned no data for issue {issue_id}")
+            else:
+                yield from issues
+
+    # Fetches a single issue and returns the outcome instead of raising, so one failure stays isolated
+    def __fetch_issue(self, issue_id):
         try:
-            all_issues = []
-            page = 1
-            for id in issues_ids_list:
-                issues_on_current_page = self.__api_call(f"/api/rest/issues/{id}", page)
-                if not issues_on_current_page:
-                    break
-                all_issues.extend(issues_on_current_page)
-                page += 1
-            return all_issues
-        except requests.RequestException as e:
-            msg = f"Failed in Mantis API Call: {e}"
-            raise Exception(msg)
+            self.__rate_limiter.acquire()
+            with metrics.timer('mantis_api_call_seconds'):
+                return issue_id, self.__api_call(f"/api/rest/issues/{issue_id}"), None
+        except (requests.RequestException, ValueError, KeyError) as e:
+            return issue_id, None, e
 
     # Mantis API call method
-    def __api_call(self, url_suffix, page):
+    def __api_call(self, url_suffix):
         url = f"{self.__mantis_config.base_url}{url_suffix}"
-        headers = self.__setup_header()
-        params = self.__setup_params()
-        params['page'] = page
-        response = requests.get(url, headers=headers, params=params)
+        response = self.__get_session().get(url, timeout=self.__mantis_config.request_timeout)
         response.raise_for_status()
+        metrics.increment('mantis_api_bytes_total', len(response.content))
         return response.json()['issues']
 
-    # Method to filter out only recently updated issues and work notes from the issues based on timestamp from value
-    def __fetch_updated_issues_and_worknotes_since_timestamp(self, issues, timestamp_from):
-        updated_issues = []
-        updated_notes = []
+    # Method to filter out only recently updated issues and work notes from the issues based on the epoch window.
+    # When the changed note ids are known from the DB they select the notes instead of the note timestamps.
+    # Attachment keys of the given issues are collected first and resolved with a single bulk lookup.
+    # Returns the NotificationRecord list of the updated issues and their updated work notes, in issue order.
+    # Each chunk is timed as the extract stage and its issues and records are counted
+    def __fetch_updated_issues_and_worknotes_since_timestamp(self, issues, epoch_from, epoch_to=None,
+                                                            changed_notes=None):
+        with metrics.timer('stage_seconds', stage='extract'), metrics.profiled('extract'):
+            records = self.__extract_records(issues, epoch_from, epoch_to, changed_notes)
+        metrics.increment('issues_total', len(issues))
+        metrics.increment('records_total', sum(record.kind == 'issue' for record in records), kind='issue')
+        metrics.increment('records_total', sum(record.kind == 'note' for record in records), kind='note')
+        return records
+
+    # Filtering, field extraction and attachment resolution of the method above
+    def __extract_records(self, issues, epoch_from, epoch_to, changed_notes):
+        time_zone = self.__mantis_config.time_zone
+        records = []
+        attachment_keys = []
         for issue in issues:
-            if is_recently_updated(issue, timestamp_from):
-                issue_data = extract_fields(issue, self.__mantis_config.issue_fields, "Issue ")
-                if is_new_issue(issue['created_at'], issue['updated_at']) :
-                    temp_attachments = self.__get_attachment_details(issue['id'])
-                    if temp_attachments:
-                        issue_data['Issue Attachments Path'] = temp_attachments
-                    updated_issues.append(issue_data)
+            if is_recently_updated(issue, epoch_from, time_zone=time_zone):
+                issue_data = extract_fields(issue, self.__mantis_config.issue_plan)
+                issue_key = None
+                if is_new_issue(issue['created_at'], issue['updated_at'], time_zone):
+                    issue_key = (issue['id'], None)
+                    attachment_keys.append(issue_key)
+                    records.append((None, NotificationRecord('issue', issue['id'], None, issue['updated_at'],
+                                                             issue_data)))
                 # Also fetch and process notes for this issue
                 notes = issue.get('notes', [])
-                for note in notes:
-                    if is_recently_updated(note, timestamp_from):
-                        note_data = extract_fields(note, self.__mantis_config.work_notes_fields, "Work Note ")
-                        note_data.update(issue_data)
-                        temp_attachments = self.__get_attachment_details(issue['id'], note['id'])
-                        if temp_attachments:
-                            note_data['Work Note Attachments Path'] = temp_attachments
-                        updated_notes.append(note_data)
-        return updated_issues, updated_notes
-
-    # Main Method of the class
-    def fetch_recently_updated_issues(self, minutes=1):
+                issue_changed_notes = changed_notes.get(issue['id'], ()) if changed_notes is not None else None
+                if issue_changed_notes is not None:
+                    notes = [note for note in notes if note['id'] in issue_changed_notes]
+                else:
+                    notes = [note for note in notes if is_recently_updated(note, epoch_from, epoch_to, time_zone)]
+                notes_data = self.__mantis_config.work_notes_plan.extract_batch(notes)
+                for note, note_data in zip(notes, notes_data):
+                    note_data.update(issue_data)
+                    attachment_keys.append((issue['id'], note['id']))
+                    records.append((issue_key, NotificationRecord('note', issue['id'], note['id'],
+                                                                  note['updated_at'], note_data)))
+        attachments = self.__get_attachment_details(attachment_keys)
+        for issue_key, record in records:
+            if record.kind == 'issue':
+                key = (record.issue_id, None)
+                if key in attachments:
+                    record.data['Issue Attachments Path'] = attachments[key]
+                continue
+            # Notes of a new issue carry the issue attachments as well
+            if issue_key in attachments:
+                record.data['Issue Attachments Path'] = attachments[issue_key]
+            key = (record.issue_id, record.note_id)
+            if key in attachments:
+                record.data['Work Note Attachments Path'] = attachments[key]
+        return [record for _, record in records]
+
+    # Method to stream the records of the given issue ids through bounded stages:
+    # fetch -> filter/extract and attachment resolution per chunk of issues -> consumer.
+    # Each stage runs ahead of the next by at most stream_buffer_size items, so peak memory stays flat,
+    # the first records are available while later issues are still fetched and a slow consumer applies
+    # backpressure to the fetch
+    def __stream_records(self, issue_ids, epoch_from, epoch_to=None, changed_notes=None, failed_ids=None):
+        buffer_size = self.__mantis_config.stream_buffer_size
+        issues = bounded_prefetch(self.__iter_issues(issue_ids, changed_notes, failed_ids), buffer_size)
+
+        def records():
+            for chunk in batched(issues, self.__mantis_config.stream_chunk_size):
+                yield from self.__fetch_updated_issues_and_worknotes_since_timestamp(chunk, epoch_from, epoch_to,
+                                                                                    changed_notes)
+        return bounded_prefetch(records(), buffer_size)
+
+    # Main Method of the class.
+    # Returns a stream of NotificationRecord for the issues and work notes updated in the last minutes
+    def stream_recently_updated_issues(self, minutes=1):
         try:
-            start_time, end_time = get_time_range(self.__mantis_config.time_zone, minutes)
-            updated_issues_ids_list = self.__mysql_handler.get_updated_issues_ids_list(start_time, end_time)
-            updated_issues_data = self.__fetch_updated_issues_between_range(updated_issues_ids_list)
-            return self.__fetch_updated_issues_and_worknotes_since_timestamp(updated_issues_data, start_time)
+            start_epoch, end_epoch = get_time_range(minutes)
+            return self.stream_updated_issues_between(start_epoch, end_epoch)
         except Exception as e:
             msg = f"Failed to fetch recently updated issues: {e}"
             raise Exception(msg)
+
+    # Returns a stream of NotificationRecord for the issues and work notes updated in the explicit
+    # (start epoch, end epoch] range. Ids of issues which failed to fetch are added to failed_ids when it is given
+    def stream_updated_issues_between(self, start_epoch, end_epoch, failed_ids=None):
+        updated_issues_ids_list, changed_notes = self.__mysql_handler.get_updated_issues_ids_list(
+            start_epoch, end_epoch, self.__mantis_config.project_id)
+        return self.__stream_records(updated_issues_ids_list, start_epoch, end_epoch, changed_notes, failed_ids)
+
+    # Collects the stream of the main method into separate lists of updated issues and updated work notes
+    def fetch_recently_updated_issues(self, minutes=1):
+        return split_records(self.stream_recently_updated_issues(minutes))
+
+    # Incremental variant of the main method driven by a persistent high-watermark cursor.
+    # Only issues changed after the cursor are fetched, and work notes are limited to the cursor window,
+    # so every change is processed once. Without a cursor the window starts the given minutes back.
+    # Returns the record stream and a function returning the cursor to store once the stream is fully delivered.
+    # The cursor never moves past the earliest change of an issue which failed to fetch with a transient error,
+    # so the next cycle fetches it again; changes after it which were already sent are then skipped by the outbox
+    # or coalescing. The attempts are counted in the cursor and an issue is skipped after max_fetch_attempts,
+    # so an issue which keeps failing does not hold the cursor forever
+    def stream_issues_since_cursor(self, cursor=None, minutes=1):
+        try:
+            if cursor is None:
+                cursor = {'last_updated': int(time.time()) - minutes * 60, 'issue_id': 0}
+            rows, note_rows, issue_ids, changed_notes, upper_bound = \
+                self.__mysql_handler.get_updated_issues_after_cursor(cursor['last_updated'], cursor['issue_id'],
+                                                                     self.__mantis_config.project_id)
+            failed_ids = set()
+            records = self.__stream_records(issue_ids, cursor['last_updated'], upper_bound - 1, changed_notes,
+                                            failed_ids)
+
+            def get_cursor():
+                attempts = count_fetch_attempts(cursor, failed_ids, self.__mantis_config.max_fetch_attempts)
+                held_ids = {int(issue_id) for issue_id in attempts}
+                if held_ids:
+                    _logger.warning(f"Cursor held before the issues which failed to fetch: {sorted(held_ids)}")
+                upper = retry_upper_bound(held_ids, rows, note_rows, upper_bound)
+                return dict(next_cursor(cursor, rows, upper), attempts=attempts)
+            return records, get_cursor
+        except Exception as e:
+            msg = f"Failed to fetch issues updated since cursor: {e}"
+            raise Exception(msg)
+
+    # Collects the stream of the incremental method into lists of updated issues and work notes and the cursor
+    def fetch_issues_since_cursor(self, cursor=None, minutes=1):
+        records, get_cursor = self.stream_issues_since_cursor(cursor, minutes)
+        return split_records(records) + (get_cursor(),)
@@ -1,23 +1,75 @@
-import win32com.client
+import time
 
 from ..config import MsmqConfig
+from ..utils.metrics import metrics
+from .sink_handler import MessageSink, SinkBatchError, record_sent_messages
 
+_MQ_SEND_ACCESS = 2
+_MQ_DENY_NONE = 0
 
-class MsmqHandler:
-    def __init__(self, config):
+
+class MsmqHandler(MessageSink):
+    # win32com is only imported when the queue is opened, so the handler can be imported off Windows
+    def __init__(self, config, transactional=False):
         self.__mantis_config = MsmqConfig(config)
+        self.__transactional = transactional
+        self.__client = None
+        self.__queue = None
 
-    # Method to send messages to queue.
-    def send_message(self, label, body):
+    # Opens the queue with send access once, the handle is reused until close is called
+    def open(self):
+        if self.__queue is not None:
+            return
         try:
+            import win32com.client
+            self.__client = win32com.client
             msmq_info = win32com.client.Dispatch("MSMQ.MSMQQueueInfo")
             msmq_info.FormatName = f"DIRECT=OS:{self.__mantis_config.queue}"
-            queue = msmq_info.Open(2, 0)  # Open the queue with send access
-            msg = win32com.client.Dispatch("MSMQ.MSMQMessage")
-            msg.Body = body
-            msg.Label = label
-            msg.Send(queue)
-            queue.Close()
+            self.__queue = msmq_info.Open(_MQ_SEND_ACCESS, _MQ_DENY_NONE)
         except Exception as e:
-            msg = f"Error sending message to MSMQ: {e}"
+            msg = f"Error opening MSMQ queue: {e}"
             raise Exception(msg)
+
+    # Closes the queue handle
+    def close(self):
+        if self.__queue is not None:
+            try:
+                self.__queue.Close()
+            finally:
+                self.__queue = None
+
+    # Method to send messages to queue.
+    def send_message(self, label, body):
+        self.send_batch([(label, body)])
+
+    # Method to send a batch of messages to queue on the open handle.
+    # On a transactional queue the whole batch is sent in one internal MSMQ transaction, otherwise a failure
+    # reports the number of messages which were already sent
+    def send_batch(self, messages):
+        transaction = None
+        sent = 0
+        try:
+            self.open()
+            start = time.perf_counter()
+            if self.__transactional:
+                dispatcher = self.__client.Dispatch("MSMQ.MSMQTransactionDispatcher")
+                transaction = dispatcher.BeginTransaction()
+            for label, body in messages:
+                msg = self.__client.Dispatch("MSMQ.MSMQMessage")
+                msg.Body = body
+                msg.Label = label
+                if transaction is not None:
+                    msg.Send(self.__queue, transaction)
+                else:
+                    msg.Send(self.__queue)
+                sent += 1
+            if transaction is not None:
+                transaction.Commit()
+            metrics.observe('sink_send_seconds', time.perf_counter() - start, sink='msmq')
+            record_sent_messages('msmq', messages)
+        except Exception as e:
+            metrics.error('sink')
+            if transaction is not None:
+                transaction.Abort()
+            msg = f"Error sending message to MSMQ: {e}"
+            raise SinkBatchError(msg, 0 if transaction is not None else sent)
@@ -1,100 +1,386 @@
-import os, io, pymysql
-from PIL import Image
+import pymysql, pytz, threading
+from datetime import datetime
 
-from src.config.config import MysqlConfig
+from src.config.config import MysqlConfig, AttachmentConfig
+from src.utils.attachment_store import AttachmentStore
+from src.utils.metrics import metrics
+from src.utils.pipeline import batched
 
+# Default Mantis enumerations, overridden by the *_enum_string values of mantis_config_table when present
+_DEFAULT_ENUMS = {
+    'status': '10:new,20:feedback,30:acknowledged,40:confirmed,50:assigned,80:resolved,90:closed',
+    'priority': '10:none,20:low,30:normal,40:high,50:urgent,60:immediate',
+    'severity': '10:feature,20:trivial,30:text,40:tweak,50:minor,60:major,70:crash,80:block',
+    'resolution': '10:open,20:fixed,30:reopened,40:unable to reproduce,50:not fixable,60:duplicate,'
+                  '70:no change required,80:suspended,90:won\'t fix',
+    'reproducibility': '10:always,30:sometimes,50:random,70:have not tried,90:unable to reproduce,100:N/A',
+    'view_state': '10:public,50:private',
+}
+_NOTE_TYPES = {0: 'note', 1: 'reminder', 2: 'timelog'}
 
-# Method to get attachments details from the mantis database for the bug id or bug note id
-def get_attachments_from_db(connection, bug_id, bug_note_id=None):
-    # SQL query to retrieve attachment information
-    with connection.cursor() as cursor:
-        sql = "SELECT filename, content FROM mantis_bug_file_table WHERE bug_id = %s"
-        params = [bug_id]
-        if bug_note_id is not None:
-            sql += " AND bugnote_id = %s"
-            params.append(bug_note_id)
-        else:
-            sql += " AND bugnote_id is NULL"
 
-        cursor.execute(sql, tuple(params))
-        attachments = cursor.fetchall()
+# Method to get attachment metadata for many (bug id, bug note id) keys with a few IN (...) queries.
+# A bug note id of None stands for attachments on the issue itself.
+# Returns a dictionary of key to list of attachment rows (id, bug_id, bugnote_id, filename)
+def get_attachments_for_keys(connection, keys, chunk_size=500):
+    keys = set(keys)
+    bug_ids = sorted({bug_id for bug_id, _ in keys})
+    matched = {}
+    with connection.cursor() as cursor:
+        for chunk in batched(bug_ids, chunk_size):
+            sql = ("SELECT id, bug_id, bugnote_id, filename FROM mantis_bug_file_table "
+                   f"WHERE bug_id IN ({', '.join(['%s'] * len(chunk))})")
+            cursor.execute(sql, tuple(chunk))
+            for row in cursor.fetchall():
+                key = (row['bug_id'], row['bugnote_id'] or None)
+                if key in keys:
+                    matched[row['id']] = row
+    attachments = {}
+    for attachment_id in sorted(matched):
+        row = matched[attachment_id]
+        attachments.setdefault((row['bug_id'], row['bugnote_id'] or None), []).append(row)
     return attachments
 
 
+# Method to stream the content of the given attachment ids.
+# An unbuffered cursor is used so only one BLOB is held in memory at a time.
+# Yields (attachment id, content) pairs
+def stream_attachment_contents(connection, attachment_ids, chunk_size=500):
+    for chunk in batched(sorted(attachment_ids), chunk_size):
+        with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            sql = ("SELECT id, content FROM mantis_bug_file_table "
+                   f"WHERE id IN ({', '.join(['%s'] * len(chunk))})")
+            cursor.execute(sql, tuple(chunk))
+            for row in cursor:
+                yield row['id'], row['content']
+
+
+# Method to parse a Mantis enum string such as "10:new,20:feedback" into a dictionary of value to name
+def parse_enum_string(enum_string):
+    enum = {}
+    for item in enum_string.split(','):
+        value, _, name = item.partition(':')
+        if name:
+            enum[int(value)] = name.strip()
+    return enum
+
+
+# Method to get the Mantis enumerations, applying the global overrides configured in mantis_config_table
+def get_enums_from_db(connection):
+    enums = {name: parse_enum_string(enum_string) for name, enum_string in _DEFAULT_ENUMS.items()}
+    config_ids = {f"{name}_enum_string": name for name in enums}
+    with connection.cursor() as cursor:
+        sql = ("SELECT config_id, value FROM mantis_config_table "
+               f"WHERE project_id = 0 AND user_id = 0 AND config_id IN ({', '.join(['%s'] * len(config_ids))})")
+        cursor.execute(sql, tuple(config_ids))
+        for row in cursor.fetchall():
+            enum = parse_enum_string(row['value'])
+            if enum:
+                enums[config_ids[row['config_id']]] = enum
+    return enums
+
+
+# Method to get issue rows joined with their text, project and category for the given issue ids
+def get_issues_from_db(connection, issue_ids, chunk_size=500):
+    issues = []
+    with connection.cursor() as cursor:
+        for chunk in batched(issue_ids, chunk_size):
+            sql = ("SELECT b.id, b.project_id, p.name AS project_name, b.category_id, c.name AS category_name, "
+                   "b.reporter_id, b.handler_id, b.priority, b.severity, b.reproducibility, b.status, "
+                   "b.resolution, b.view_state, b.summary, b.date_submitted, b.last_updated, "
+                   "t.description, t.steps_to_reproduce, t.additional_information "
+                   "FROM mantis_bug_table b "
+                   "JOIN mantis_bug_text_table t ON t.id = b.bug_text_id "
+                   "LEFT JOIN mantis_project_table p ON p.id = b.project_id "
+                   "LEFT JOIN mantis_category_table c ON c.id = b.category_id "
+                   f"WHERE b.id IN ({', '.join(['%s'] * len(chunk))})")
+            cursor.execute(sql, tuple(chunk))
+            issues.extend(cursor.fetchall())
+    return issues
+
+
+# Method to get work note rows joined with their text for the given issue ids.
+# When note ids are given only those notes are read
+def get_notes_from_db(connection, issue_ids, note_ids=None, chunk_size=500):
+    notes = []
+    column, ids = ('n.id', note_ids) if note_ids is not None else ('n.bug_id', issue_ids)
+    with connection.cursor() as cursor:
+        for chunk in batched(sorted(ids), chunk_size):
+            sql = ("SELECT n.id, n.bug_id, n.reporter_id, n.view_state, n.note_type, n.date_submitted, "
+                   "n.last_modified, nt.note "
+                   "FROM mantis_bugnote_table n "
+                   "JOIN mantis_bugnote_text_table nt ON nt.id = n.bugnote_text_id "
+                   f"WHERE {column} IN ({', '.join(['%s'] * len(chunk))})")
+            cursor.execute(sql, tuple(chunk))
+            notes.extend(cursor.fetchall())
+    notes.sort(key=lambda note: (note['bug_id'], note['id']))
+    return notes
+
+
+# Method to get user rows for the given user ids as a dictionary of user id to row
+def get_users_from_db(connection, user_ids, chunk_size=500):
+    users = {}
+    with connection.cursor() as cursor:
+        for chunk in batched(sorted(user_ids), chunk_size):
+            sql = ("SELECT id, username, realname, email FROM mantis_user_table "
+                   f"WHERE id IN ({', '.join(['%s'] * len(chunk))})")
+            cursor.execute(sql, tuple(chunk))
+            for row in cursor.fetchall():
+                users[row['id']] = row
+    return users
+
+
+# Method to build issue dictionaries shaped like the Mantis REST API /issues/{id} response
+# from issue, note and user rows, so that they can be used in place of the API response
+def build_issues(issue_rows, note_rows, users, enums, time_zone):
+    target_timezone = pytz.timezone(time_zone)
+
+    def to_iso(epoch):
+        return datetime.fromtimestamp(epoch, target_timezone).isoformat()
+
+    def user(user_id):
+        row = users.get(user_id)
+        if not row:
+            return {'id': user_id}
+        return {'id': row['id'], 'name': row['username'], 'real_name': row['realname'], 'email': row['email']}
+
+    def enum(name, value):
+        label = enums[name].get(value, f"@{value}@")
+        return {'id': value, 'name': label, 'label': label}
+
+    notes_by_issue = {}
+    for row in note_rows:
+        notes_by_issue.setdefault(row['bug_id'], []).append({
+            'id': row['id'],
+            'reporter': user(row['reporter_id']),
+            'text': row['note'],
+            'view_state': enum('view_state', row['view_state']),
+            'type': _NOTE_TYPES.get(row['note_type'], row['note_type']),
+            'created_at': to_iso(row['date_submitted']),
+            'updated_at': to_iso(row['last_modified']),
+        })
+    issues = []
+    for row in issue_rows:
+        issue = {
+            'id': row['id'],
+            'summary': row['summary'],
+            'description': row['description'],
+            'steps_to_reproduce': row['steps_to_reproduce'],
+            'additional_information': row['additional_information'],
+            'project': {'id': row['project_id'], 'name': row['project_name']},
+            'category': {'id': row['category_id'], 'name': row['category_name']},
+            'reporter': user(row['reporter_id']),
+            'status': enum('status', row['status']),
+            'resolution': enum('resolution', row['resolution']),
+            'view_state': enum('view_state', row['view_state']),
+            'priority': enum('priority', row['priority']),
+            'severity': enum('severity', row['severity']),
+            'reproducibility': enum('reproducibility', row['reproducibility']),
+            'created_at': to_iso(row['date_submitted']),
+            'updated_at': to_iso(row['last_updated']),
+            'notes': notes_by_issue.get(row['id'], []),
+        }
+        # The REST API leaves the handler out for unassigned issues
+        if row['handler_id']:
+            issue['handler'] = user(row['handler_id'])
+        issues.append(issue)
+    return issues
+
+
+# Method to combine changed issue rows and changed note rows (bug_id, id).
+# Returns the ordered issue ids, including issues with only changed notes,
+# and a dictionary of issue id to the set of changed note ids
+def merge_changed_rows(issue_rows, note_rows):
+    issue_ids = [row['id'] for row in issue_rows]
+    changed_notes = {}
+    for row in note_rows:
+        changed_notes.setdefault(row['bug_id'], set()).add(row['id'])
+    known_ids = set(issue_ids)
+    issue_ids.extend(bug_id for bug_id in changed_notes if bug_id not in known_ids)
+    return issue_ids, changed_notes
+
+
 class MysqlHandler:
-    def __init__(self, mysql_config, attachment_base_dir):
+    # A given attachment store is shared with other handlers and left open on close
+    def __init__(self, mysql_config, attachment_base_dir, attachment_config=None, attachment_store=None):
         self.__config = MysqlConfig(mysql_config)
-        self.__attachment_base_dir = attachment_base_dir
+        self.__owns_attachment_store = attachment_store is None
+        if attachment_store is None:
+            attachment_config = AttachmentConfig(attachment_config or {})
+            attachment_store = AttachmentStore(attachment_base_dir, attachment_config.convert_to_png,
+                                               attachment_config.convert_workers)
+        self.__attachment_store = attachment_store
+        self.__connection = None
+        self.__enums = None
+        # The reused connection is shared by the pipeline threads, so its use is serialised
+        self.__lock = threading.RLock()
 
-    # Get the database connection settings
+    # Get the database connection. The connection is opened once and reused,
+    # it is pinged before use so that a connection dropped by the server is re-established
     def __get_connection(self):
-        # Connect to the database using the configuration
-        connection = pymysql.connect(
-            host=self.__config.host,
-            user=self.__config.user,
-            password=self.__config.password,
-            database=self.__config.database,
-            charset=self.__config.charset,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        return connection
-
-    # Method to get the list of updated issues ids for the given start and end timestamps
-    def get_updated_issues_ids_list(self, start_time, end_time):
-        connection = None
-        issue_ids = []
-        try:
-            # Connect to the database
-            connection = self.__get_connection()
-            with connection.cursor() as cursor:
-
-                cursor.callproc('GetUpdatedIssues', (start_time, end_time))
-                results = cursor.fetchall()
-                # Extract values from dictionaries into a list
-                for result in results:
-                    issue_ids.append(result['id'])
-                return issue_ids
-        except pymysql.Error as e:
-            raise Exception(f"An unexpected error occurred while fetching attachment from mysql DB: {e}")
-        finally:
-            if connection:
-                connection.close()
+        if self.__connection is None:
+            # Connect to the database using the configuration
+            self.__connection = pymysql.connect(
+                host=self.__config.host,
+                user=self.__config.user,
+                password=self.__config.password,
+                database=self.__config.database,
+                charset=self.__config.charset,
+                cursorclass=pymysql.cursors.DictCursor,
+                autocommit=True
+            )
+        else:
+            self.__connection.ping(reconnect=True)
+        return self.__connection
+
+    @property
+    def attachment_store(self):
+        return self.__attachment_store
+
+    # Closes the reused database connection and the conversion pool of an attachment store of its own
+    def close(self):
+        with self.__lock:
+            self.__close_connection()
+            if self.__owns_attachment_store:
+                self.__attachment_store.close()
+
+    # Drops the connection after an error, the next call opens a fresh one
+    def __close_connection(self):
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except pymysql.Error:
+                pass
+            self.__connection = None
+
+    # Method to get the list of updated issues ids for the given start and end epoch timestamps.
+    # Also returns the changed work notes as a dictionary of issue id to the set of changed note ids,
+    # issues which only had work notes changed are included in the issue ids
+    def get_updated_issues_ids_list(self, start_epoch, end_epoch, project_id=0):
+        with self.__lock, metrics.timer('mysql_call_seconds', call='get_updated_issues'):
+            try:
+                connection = self.__get_connection()
+                with connection.cursor() as cursor:
+                    cursor.callproc('GetUpdatedIssuesAndNotes', (start_epoch, end_epoch, project_id))
+                    issue_rows = cursor.fetchall()
+                    note_rows = cursor.fetchall() if cursor.nextset() else ()
+                    return merge_changed_rows(issue_rows, note_rows)
+            except pymysql.Error as e:
+                metrics.error('mysql')
+                self.__close_connection()
+                raise Exception(f"An unexpected error occurred while fetching updated issues from mysql DB: {e}")
+
+    # Method to get the issues and work notes changed after the given cursor.
+    # Only seconds which have fully elapsed on the DB server are read, so a cursor never skips rows
+    # which are still being written. Returns the issue rows (id, last_updated) in cursor order,
+    # the note rows (bug_id, id, last_modified), the issue ids, the changed notes as a dictionary of issue id
+    # to note ids and the exclusive upper epoch bound which was used
+    def get_updated_issues_after_cursor(self, last_updated, issue_id, project_id=0):
+        with self.__lock, metrics.timer('mysql_call_seconds', call='get_updated_issues_after_cursor'):
+            try:
+                connection = self.__get_connection()
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT UNIX_TIMESTAMP() AS now")
+                    upper_bound = int(cursor.fetchone()['now'])
+                    sql = ("SELECT id, last_updated FROM mantis_bug_table "
+                           "WHERE last_updated < %s AND (last_updated > %s OR (last_updated = %s AND id > %s)) "
+                           "AND (%s = 0 OR project_id = %s) "
+                           "ORDER BY last_updated, id")
+                    cursor.execute(sql, (upper_bound, last_updated, last_updated, issue_id, project_id, project_id))
+                    issue_rows = cursor.fetchall()
+                    sql = ("SELECT n.bug_id, n.id, n.last_modified FROM mantis_bugnote_table n "
+                           "JOIN mantis_bug_table b ON b.id = n.bug_id "
+                           "WHERE n.last_modified > %s AND n.last_modified < %s AND (%s = 0 OR b.project_id = %s) "
+                           "ORDER BY n.bug_id, n.id")
+                    cursor.execute(sql, (last_updated, upper_bound, project_id, project_id))
+                    note_rows = cursor.fetchall()
+                    issue_ids, changed_notes = merge_changed_rows(issue_rows, note_rows)
+                    return issue_rows, note_rows, issue_ids, changed_notes, upper_bound
+            except pymysql.Error as e:
+                metrics.error('mysql')
+                self.__close_connection()
+                raise Exception(f"An unexpected error occurred while fetching updated issues from mysql DB: {e}")
 
-    # Method to download the attachments for bug id and bug note id. Also returns the path of downloaded files
-    def __download_attachments(self, attachments, bug_id, bug_note_id):
-        results = []
+    # Method to read the given issues with their work notes directly from the database in a few bulk queries.
+    # When changed notes are given only those notes are read. Issues keep the order of the given ids
+    def fetch_issues(self, issue_ids, time_zone, changed_notes=None):
+        with self.__lock, metrics.timer('mysql_call_seconds', call='fetch_issues'):
+            if not issue_ids:
+                return []
+            try:
+                connection = self.__get_connection()
+                if self.__enums is None:
+                    self.__enums = get_enums_from_db(connection)
+                issue_rows = get_issues_from_db(connection, issue_ids)
+                note_ids = None
+                if changed_notes is not None:
+                    note_ids = {note_id for note_ids in changed_notes.values() for note_id in note_ids}
+                note_rows = get_notes_from_db(connection, issue_ids, note_ids) if note_ids != set() else []
+                user_ids = {row['reporter_id'] for row in issue_rows + note_rows}
+                user_ids.update(row['handler_id'] for row in issue_rows if row['handler_id'])
+                users = get_users_from_db(connection, user_ids) if user_ids else {}
+            except pymysql.Error as e:
+                metrics.error('mysql')
+                self.__close_connection()
+                raise Exception(f"An unexpected error occurred while fetching issues from mysql DB: {e}")
+            position = {issue_id: index for index, issue_id in enumerate(issue_ids)}
+            issue_rows = sorted(issue_rows, key=lambda row: position[row['id']])
+            return build_issues(issue_rows, note_rows, users, self.__enums, time_zone)
+
+    # Method to store the attachments of a cycle in the content addressed store.
+    # Content is only read from the DB for attachments which are not stored yet.
+    # Returns a dictionary of attachment id to the path of the stored (and optionally converted) file
+    def __download_attachments(self, connection, attachment_ids):
+        results = {}
+        missing_ids = []
+        for attachment_id, filename in attachment_ids.items():
+            path = self.__attachment_store.get_path(attachment_id)
+            if path:
+                results[attachment_id] = path
+            else:
+                missing_ids.append(attachment_id)
+        metrics.increment('attachments_total', len(results), source='store')
         try:
-            for attachment in attachments:
-                filename = attachment['filename']
-                content = attachment['content']
-                image = Image.open(io.BytesIO(content))
-
-                # Create directories if they do not exist
-                bug_folder = os.path.join(self.__attachment_base_dir, f"bug_{bug_id}")
-                note_folder = os.path.join(bug_folder, f"note_{bug_note_id}") if bug_note_id else bug_folder
-                os.makedirs(note_folder, exist_ok=True)
-
-                # Save the image as PNG in the appropriate folder
-                save_path = os.path.join(note_folder, filename)
-                image.save(save_path, format='PNG')
-                absolute_path = os.path.abspath(save_path)
-                results.append(absolute_path)
-            return results
+            with metrics.profiled('attachments'):
+                for attachment_id, content in stream_attachment_contents(connection, missing_ids):
+                    results[attachment_id] = self.__attachment_store.store(attachment_id,
+                                                                           attachment_ids[attachment_id], content)
+                    metrics.increment('attachments_total', source='db')
+                    metrics.increment('attachment_bytes_total', len(content))
         except IOError as e:
+            metrics.error('attachments')
             raise Exception(f"An error occurred while downloading attachments: {e}")
+        finally:
+            self.__attachment_store.save_index()
+        ordered_ids = sorted(results)
+        try:
+            converted = self.__attachment_store.convert([results[attachment_id] for attachment_id in ordered_ids])
+        finally:
+            self.__attachment_store.save_index()
+        return dict(zip(ordered_ids, converted))
+
+    # Method to download the attachments of many (bug id, bug note id) keys at once on the reused connection.
+    # Returns a dictionary of key to the paths of downloaded files, keys without attachments are left out
+    def fetch_attachments_bulk(self, keys):
+        with self.__lock, metrics.timer('mysql_call_seconds', call='fetch_attachments'):
+            results = {}
+            if not keys:
+                return results
+            try:
+                connection = self.__get_connection()
+                attachments = get_attachments_for_keys(connection, keys)
+                attachment_ids = {row['id']: row['filename'] for rows in attachments.values() for row in rows}
+                paths = self.__download_attachments(connection, attachment_ids)
+            except pymysql.Error as e:
+                metrics.error('mysql')
+                self.__close_connection()
+                raise Exception(f"An unexpected error occurred while fetching attachment from mysql DB: {e}")
+            for key, rows in attachments.items():
+                key_paths = [paths[row['id']] for row in rows if row['id'] in paths]
+                if key_paths:
+                    results[key] = key_paths
+            return results
 
     # Main Method of the class
     def fetch_attachments(self, bug_id, bug_note_id=None):
-        connection = None
-        try:
-            # Connect to the database
-            connection = self.__get_connection()
-            attachments = get_attachments_from_db(connection, bug_id, bug_note_id)
-            if attachments:
-                results = self.__download_attachments(attachments, bug_id, bug_note_id)
-                return results
-        except pymysql.Error as e:
-            raise Exception(f"An unexpected error occurred while fetching attachment from mysql DB: {e}")
-        finally:
-            if connection:
-                connection.close()
+        return self.fetch_attachments_bulk([(bug_id, bug_note_id)]).get((bug_id, bug_note_id))
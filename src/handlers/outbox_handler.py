@@ -0,0 +1,157 @@
+import os, sqlite3, time
+
+from src.handlers.sink_handler import SinkBatchError
+from src.utils.pipeline import batched
+
+_PENDING = 'pending'
+_DELIVERED = 'delivered'
+# Keys per query, below the SQLite limit of host parameters
+_KEYS_PER_QUERY = 500
+
+
+# Durable local outbox in SQLite (WAL mode).
+# Messages are stored under a deterministic idempotency key, so a change seen again by a later cycle
+# is never queued twice, and are drained to the sink separately, retrying only the failed entries.
+# A message which combines several changes, like a grouped issue message, also stores the keys of its
+# member changes, so a change which is already part of a queued message is not queued again in another group
+class OutboxHandler:
+    def __init__(self, file_path, max_attempts=10, retention_days=7):
+        self.__file_path = os.path.abspath(file_path)
+        self.__max_attempts = max_attempts
+        self.__retention_days = retention_days
+        self.__connection = None
+
+    # Opens the outbox database and creates the outbox table if needed
+    def __get_connection(self):
+        if self.__connection is None:
+            os.makedirs(os.path.dirname(self.__file_path), exist_ok=True)
+            connection = sqlite3.connect(self.__file_path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                               "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "key TEXT NOT NULL UNIQUE, label TEXT NOT NULL, body TEXT NOT NULL, "
+                               "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, "
+                               "created_at REAL NOT NULL, delivered_at REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, seq)")
+            connection.execute("CREATE TABLE IF NOT EXISTS outbox_member ("
+                               "key TEXT PRIMARY KEY, message_key TEXT NOT NULL)")
+            connection.commit()
+            self.__connection = connection
+        return self.__connection
+
+    # Closes the outbox database
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    # Method to add (key, label, body) messages to the outbox in one transaction, together with the
+    # (member key, message key) pairs of messages which combine several changes.
+    # Keys which are already in the outbox are ignored. Returns the number of newly added messages
+    def enqueue(self, messages, members=()):
+        try:
+            connection = self.__get_connection()
+            created_at = time.time()
+            with connection:
+                before = connection.total_changes
+                connection.executemany("INSERT OR IGNORE INTO outbox (key, label, body, status, created_at) "
+                                       "VALUES (?, ?, ?, ?, ?)",
+                                       [(key, label, body, _PENDING, created_at) for key, label, body in messages])
+                added = connection.total_changes - before
+                connection.executemany("INSERT OR IGNORE INTO outbox_member (key, message_key) VALUES (?, ?)",
+                                       members)
+                return added
+        except sqlite3.Error as e:
+            raise Exception(f"Error writing messages to the outbox: {e}")
+
+    # Method to get the given keys which are already in the outbox, as a message or as a member of one
+    def known_keys(self, keys):
+        try:
+            connection = self.__get_connection()
+            known = set()
+            for chunk in batched(keys, _KEYS_PER_QUERY):
+                placeholders = ', '.join('?' * len(chunk))
+                cursor = connection.execute(f"SELECT key FROM outbox WHERE key IN ({placeholders}) "
+                                            f"UNION SELECT key FROM outbox_member WHERE key IN ({placeholders})",
+                                            chunk + chunk)
+                known.update(key for key, in cursor)
+            return known
+        except sqlite3.Error as e:
+            raise Exception(f"Error reading keys from the outbox: {e}")
+
+    # Method to get up to limit pending (seq, key, label, body) messages after the given sequence number
+    # in insertion order, skipping messages which ran out of attempts
+    def pending(self, limit, after_seq=0):
+        try:
+            cursor = self.__get_connection().execute(
+                "SELECT seq, key, label, body FROM outbox WHERE status = ? AND attempts < ? AND seq > ? "
+                "ORDER BY seq LIMIT ?", (_PENDING, self.__max_attempts, after_seq, limit))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            raise Exception(f"Error reading messages from the outbox: {e}")
+
+    # Method to mark the given keys as delivered
+    def mark_delivered(self, keys):
+        connection = self.__get_connection()
+        delivered_at = time.time()
+        with connection:
+            connection.executemany("UPDATE outbox SET status = ?, delivered_at = ?, last_error = NULL WHERE key = ?",
+                                   [(_DELIVERED, delivered_at, key) for key in keys])
+
+    # Method to record a failed delivery attempt of the given key
+    def mark_failed(self, key, error):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute("UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE key = ?",
+                               (str(error), key))
+
+    # Method to count the messages still waiting for delivery, split into retryable and exhausted ones
+    def count_pending(self):
+        cursor = self.__get_connection().execute(
+            "SELECT COALESCE(SUM(attempts < ?), 0), COALESCE(SUM(attempts >= ?), 0) FROM outbox WHERE status = ?",
+            (self.__max_attempts, self.__max_attempts, _PENDING))
+        return cursor.fetchone()
+
+    # Method to remove delivered messages older than the retention period together with their member keys.
+    # Their keys are kept for the retention period so that repeated changes are not queued again
+    def purge_delivered(self):
+        connection = self.__get_connection()
+        with connection:
+            connection.execute("DELETE FROM outbox WHERE status = ? AND delivered_at < ?",
+                               (_DELIVERED, time.time() - self.__retention_days * 86400))
+            connection.execute("DELETE FROM outbox_member WHERE message_key NOT IN (SELECT key FROM outbox)")
+
+    # Method to send pending messages to the sink in batches and mark them delivered.
+    # When a batch fails the messages the sink reports as sent are marked delivered and only the rest is
+    # retried one by one, so only the failing ones stay pending. Draining stops when a whole batch fails
+    # as the sink is then most likely unavailable.
+    # Returns the number of delivered and failed messages and whether draining stopped on a failed batch
+    def drain(self, sink, batch_size, on_sent=None):
+        delivered, failed = 0, 0
+        last_seq = 0
+        while True:
+            batch = self.pending(batch_size, last_seq)
+            if not batch:
+                break
+            last_seq = batch[-1][0]
+            try:
+                sink.send_batch([(label, body) for _, _, label, body in batch])
+                sent = [(key, label) for _, key, label, _ in batch]
+            except Exception as e:
+                already_sent = e.sent if isinstance(e, SinkBatchError) else 0
+                sent = [(key, label) for _, key, label, _ in batch[:already_sent]]
+                for _, key, label, body in batch[already_sent:]:
+                    try:
+                        sink.send_message(label, body)
+                        sent.append((key, label))
+                    except Exception as e:
+                        self.mark_failed(key, e)
+                        failed += 1
+            self.mark_delivered([key for key, _ in sent])
+            delivered += len(sent)
+            if on_sent:
+                on_sent([label for _, label in sent])
+            if not sent:
+                return delivered, failed, True
+        return delivered, failed, False
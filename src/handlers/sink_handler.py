@@ -0,0 +1,65 @@
+from src.config.config import SinkConfig
+from src.utils.metrics import metrics
+
+
+# Error of a batch send which failed partway, sent is the number of leading messages of the batch which were
+# delivered before the failure. Sinks which send a batch atomically report 0
+class SinkBatchError(Exception):
+    def __init__(self, msg, sent=0):
+        super().__init__(msg)
+        self.sent = sent
+
+
+# Base class of the message sinks the notification messages are delivered to.
+# A sink is opened once per cycle and keeps its queue handle open until it is closed
+class MessageSink:
+    # Opens the underlying queue handle
+    def open(self):
+        pass
+
+    # Closes the underlying queue handle
+    def close(self):
+        pass
+
+    # Method to send a single message to the sink
+    def send_message(self, label, body):
+        raise NotImplementedError
+
+    # Method to send a batch of (label, body) messages. Sinks which support it send the batch atomically,
+    # others raise SinkBatchError with the number of messages sent before the failure
+    def send_batch(self, messages):
+        sent = 0
+        try:
+            for label, body in messages:
+                self.send_message(label, body)
+                sent += 1
+        except Exception as e:
+            raise SinkBatchError(str(e), sent)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Counts the messages and body bytes of a batch sent to the named sink
+def record_sent_messages(sink_name, messages):
+    metrics.increment('messages_sent_total', len(messages), sink=sink_name)
+    metrics.increment('message_bytes_total', sum(len(body) for _, body in messages), sink=sink_name)
+
+
+# Creates the sink configured in the sink section, defaulting to MSMQ when no sink section is present
+def create_sink(config):
+    sink_config = SinkConfig(config.get('sink') or {})
+    if sink_config.type == 'msmq':
+        from src.handlers.msmq_handler import MsmqHandler
+        return MsmqHandler(config['msmq'], sink_config.transactional)
+    if sink_config.type == 'file':
+        from src.handlers.local_sink_handler import FileSinkHandler
+        return FileSinkHandler(sink_config.path)
+    if sink_config.type == 'sqlite':
+        from src.handlers.local_sink_handler import SqliteSinkHandler
+        return SqliteSinkHandler(sink_config.path)
+    raise ValueError(f"Unsupported sink type '{sink_config.type}', expected 'msmq', 'file' or 'sqlite'")
@@ -1 +1,9 @@
-from .logger import CustomLogger
\ No newline at end of file
+from .logger import CustomLogger, SentMessageLog
+from .attachment_store import AttachmentStore
+from .cursor_store import CursorStore
+from .time_utils import to_epoch
+from .file_utils import write_atomic
+from .rate_limiter import RateLimiter
+from .checkpoint_store import CheckpointStore
+from .metrics import Metrics, metrics
+from .payload import PayloadEncoder
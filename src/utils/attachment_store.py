@@ -0,0 +1,173 @@
+import hashlib, json, os, sqlite3, tempfile, threading
+from concurrent.futures import ProcessPoolExecutor
+
+_CHUNK_SIZE = 1024 * 1024
+_INDEX_FILE = 'index.db'
+_JSON_INDEX_FILE = 'index.json'
+
+
+# Converts an image attachment to PNG next to the stored file and returns the path of the converted file.
+# Files which are already PNG or are not images are returned unchanged. Runs inside the process pool
+def convert_to_png(path):
+    if path.lower().endswith('.png'):
+        return path
+    from PIL import Image, UnidentifiedImageError
+    target = os.path.splitext(path)[0] + '.png'
+    if os.path.exists(target):
+        return target
+    try:
+        with Image.open(path) as image:
+            image.save(target, format='PNG')
+        return target
+    except (UnidentifiedImageError, OSError):
+        return path
+
+
+# Content addressed attachment store.
+# Files are written once under objects/<hash prefix>/<sha256>/<filename>, so identical content is never rewritten.
+# An index of Mantis attachment id to stored path lets callers skip reading content which is already stored,
+# and the index of stored path to converted path (the stored path itself for PNG files and non images)
+# lets the conversion skip files which were handled before. Both indexes live in a SQLite database with one row
+# per file, so recording a file only writes its own row, and rows of files which were removed are pruned when
+# they are looked up. The store is thread safe, so handlers running concurrently in one process can share it
+class AttachmentStore:
+    def __init__(self, base_dir, convert_to_png=False, convert_workers=None):
+        self.__base_dir = os.path.abspath(base_dir)
+        self.__convert_to_png = convert_to_png
+        self.__convert_workers = convert_workers
+        self.__executor = None
+        self.__index_path = os.path.join(self.__base_dir, _INDEX_FILE)
+        self.__connection = None
+        self.__lock = threading.RLock()
+
+    # Opens the index database and creates its tables if needed. An index file of the earlier JSON format
+    # is imported once and removed
+    def __get_connection(self):
+        if self.__connection is None:
+            os.makedirs(self.__base_dir, exist_ok=True)
+            connection = sqlite3.connect(self.__index_path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS attachment (id TEXT PRIMARY KEY, path TEXT NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS conversion ("
+                               "path TEXT PRIMARY KEY, converted TEXT NOT NULL)")
+            self.__import_json_index(connection)
+            connection.commit()
+            self.__connection = connection
+        return self.__connection
+
+    # Imports the attachment id and conversion indexes of an index.json of the earlier format
+    def __import_json_index(self, connection):
+        json_path = os.path.join(self.__base_dir, _JSON_INDEX_FILE)
+        try:
+            with open(json_path, 'r') as file:
+                content = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            content = {}
+        if 'paths' in content and isinstance(content['paths'], dict):
+            paths, converted = content['paths'], content.get('converted') or {}
+        else:
+            paths, converted = content, {}
+        connection.executemany("INSERT OR IGNORE INTO attachment (id, path) VALUES (?, ?)", paths.items())
+        connection.executemany("INSERT OR IGNORE INTO conversion (path, converted) VALUES (?, ?)", converted.items())
+        connection.commit()
+        os.remove(json_path)
+
+    # Returns the stored path of the attachment id if its file is still present on disk,
+    # the row of a removed file is pruned
+    def get_path(self, attachment_id):
+        with self.__lock:
+            connection = self.__get_connection()
+            row = connection.execute("SELECT path FROM attachment WHERE id = ?", (str(attachment_id),)).fetchone()
+            if row is None:
+                return None
+            if os.path.exists(row[0]):
+                return row[0]
+            connection.execute("DELETE FROM attachment WHERE id = ?", (str(attachment_id),))
+            return None
+
+    # Streams the content to disk while hashing it and returns the content addressed path.
+    # Content may be bytes or an iterable of byte chunks
+    def store(self, attachment_id, filename, content):
+        os.makedirs(self.__base_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.__base_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in _iter_chunks(content):
+                    digest.update(chunk)
+                    file.write(chunk)
+            sha = digest.hexdigest()
+            folder = os.path.join(self.__base_dir, 'objects', sha[:2], sha)
+            path = os.path.join(folder, os.path.basename(filename) or sha)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(folder, exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self.__lock:
+            self.__get_connection().execute("INSERT OR REPLACE INTO attachment (id, path) VALUES (?, ?)",
+                                            (str(attachment_id), path))
+        return path
+
+    # Applies the optional PNG conversion to the given paths, keeping their order.
+    # Only files without a recorded conversion are sent to the process pool, which stays open until close
+    def convert(self, paths):
+        if not self.__convert_to_png or not paths:
+            return paths
+        with self.__lock:
+            converted = {path: self.__get_converted(path) for path in set(paths)}
+            pending = sorted(path for path, target in converted.items() if target is None)
+            if pending:
+                if self.__executor is None:
+                    self.__executor = ProcessPoolExecutor(max_workers=self.__convert_workers)
+                converted.update(zip(pending, self.__executor.map(convert_to_png, pending)))
+                self.__get_connection().executemany(
+                    "INSERT OR REPLACE INTO conversion (path, converted) VALUES (?, ?)",
+                    [(path, converted[path]) for path in pending])
+            return [converted[path] for path in paths]
+
+    # Returns the recorded conversion of the stored file if its result is still on disk,
+    # the row of a removed result is pruned
+    def __get_converted(self, path):
+        connection = self.__get_connection()
+        row = connection.execute("SELECT converted FROM conversion WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        if os.path.exists(row[0]):
+            return row[0]
+        connection.execute("DELETE FROM conversion WHERE path = ?", (path,))
+        return None
+
+    # Shuts the conversion process pool down and closes the index database
+    def close(self):
+        with self.__lock:
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+            if self.__connection is not None:
+                self.__connection.commit()
+                self.__connection.close()
+                self.__connection = None
+
+    # Commits the index rows recorded since the last call
+    def save_index(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.commit()
+
+
+# Yields the content in chunks without copying it
+def _iter_chunks(content):
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        view = memoryview(content)
+        for offset in range(0, len(view), _CHUNK_SIZE):
+            yield view[offset:offset + _CHUNK_SIZE]
+    else:
+        yield from content
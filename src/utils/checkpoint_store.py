@@ -0,0 +1,30 @@
+import json, os
+
+from src.utils.file_utils import write_atomic
+
+
+# Checkpoint of a backfill kept in a local JSON state file.
+# Holds the (start epoch, end epoch) chunks of the backfill range which were completely sent
+class CheckpointStore:
+    def __init__(self, file_path):
+        self.__file_path = os.path.abspath(file_path)
+        self.__completed = self.__load()
+
+    # Loads the completed chunks, a missing file means nothing was completed yet
+    def __load(self):
+        try:
+            with open(self.__file_path, 'r') as file:
+                return {tuple(chunk) for chunk in json.load(file)['completed']}
+        except FileNotFoundError:
+            return set()
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception(f"Error reading checkpoint file '{self.__file_path}': {e}")
+
+    # Returns True when the chunk was completed by this or an earlier run
+    def is_completed(self, chunk):
+        return tuple(chunk) in self.__completed
+
+    # Records the chunk as completed and atomically rewrites the checkpoint file
+    def mark_completed(self, chunk):
+        self.__completed.add(tuple(chunk))
+        write_atomic(self.__file_path, json.dumps({'completed': sorted(self.__completed)}))
@@ -0,0 +1,29 @@
+import json, os
+
+from src.utils.file_utils import write_atomic
+
+
+# Durable high-watermark cursor kept in a local JSON state file.
+# The cursor holds the last processed `last_updated` epoch value and issue id, and the fetch attempts by issue id
+# of the issues which hold it
+class CursorStore:
+    def __init__(self, file_path):
+        self.__file_path = os.path.abspath(file_path)
+
+    # Returns the stored cursor or None when no cursor has been saved yet
+    def load(self):
+        try:
+            with open(self.__file_path, 'r') as file:
+                content = json.load(file)
+            return {'last_updated': int(content['last_updated']), 'issue_id': int(content['issue_id']),
+                    'attempts': {str(issue_id): int(count) for issue_id, count in content.get('attempts', {}).items()}}
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            raise Exception(f"Error reading cursor file '{self.__file_path}': {e}")
+
+    # Atomically replaces the stored cursor
+    def save(self, cursor):
+        write_atomic(self.__file_path, json.dumps({'last_updated': cursor['last_updated'],
+                                                   'issue_id': cursor['issue_id'],
+                                                   'attempts': cursor.get('attempts', {})}))
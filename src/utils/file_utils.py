@@ -0,0 +1,19 @@
+import os, tempfile
+
+
+# Writes the text content to the file through a synced temporary file in the same folder, which then replaces
+# the file, so readers and a crash never leave a partial file behind. The folder is created when missing
+def write_atomic(file_path, content):
+    folder = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
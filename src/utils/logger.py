@@ -1,38 +1,126 @@
-import logging
+import atexit, json, logging, os, queue
+from collections import Counter
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
-from src.config.config import read_config
+from src.config.config import read_config, LoggingConfig
 
 
-# Custom Logging Class
+# Formats log records as JSON lines
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'module': record.module,
+            'function': record.funcName,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Custom Logging Class.
+# The logging section is read from the config file unless it is given, e.g. the section of a shard config.
+# A process logs to one file at a time: a shard worker process which goes on with another shard
+# closes the log file of the previous shard and continues in the file of the new one
 class CustomLogger:
     _instance = None
 
-    def __new__(cls, *args, **kwargs):
+    def __new__(cls, config_file, logging_config=None):
+        config = LoggingConfig(logging_config or read_config(config_file, 'logging'))
+        if cls._instance and cls._instance.log_file != config.logging_file:
+            cls._instance.shutdown()
+            cls._instance = None
         if not cls._instance:
             cls._instance = super(CustomLogger, cls).__new__(cls)
-            cls._instance._initialize_logger(*args, **kwargs)
+            cls._instance._initialize_logger(config)
         return cls._instance
 
-    # Initialize the logger with logging file, level, format etc
-    def _initialize_logger(self, config_file):
-        self.config = read_config(config_file,'logging')
-        self.log_file = self.config['logging_file']
-        self.log_level = getattr(logging, self.config['logging_level'].upper())
-        self.formatter = self.config['logging_format']
+    # Initialize the logger with logging file, level, format etc.
+    # In async mode the root logger only puts records on a queue and a background listener thread
+    # formats and writes them, so the pipeline threads never wait for file I/O
+    def _initialize_logger(self, config):
+        self.config = config
+        self.log_file = self.config.logging_file
+        self.log_level = getattr(logging, self.config.logging_level.upper())
+        self.formatter = self.config.logging_format
+        self.listener = None
+        self.handlers = []
         self.logger = logging.getLogger()
         self.logger.setLevel(self.log_level)
         if not self.logger.hasHandlers():
             # File handler
-            file_handler = logging.FileHandler(self.log_file)
+            file_handler = self.__create_file_handler()
             file_handler.setLevel(self.log_level)
 
             # Formatter
-            formatter = logging.Formatter(self.formatter)
+            formatter = JsonFormatter() if self.config.json else logging.Formatter(self.formatter)
             file_handler.setFormatter(formatter)
 
             # Add handlers to the logger
-            self.logger.addHandler(file_handler)
+            if self.config.use_queue:
+                log_queue = queue.Queue(-1)
+                self.handlers = [QueueHandler(log_queue), file_handler]
+                self.listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+                self.listener.start()
+                atexit.register(self.shutdown)
+            else:
+                self.handlers = [file_handler]
+            self.logger.addHandler(self.handlers[0])
+
+    # Creates the file handler with the configured rotation, the folder of the log file is created when missing
+    def __create_file_handler(self):
+        folder = os.path.dirname(self.log_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if self.config.rotation == 'size':
+            return RotatingFileHandler(self.log_file, maxBytes=self.config.max_bytes,
+                                       backupCount=self.config.backup_count)
+        if self.config.rotation == 'time':
+            return TimedRotatingFileHandler(self.log_file, when=self.config.when,
+                                            backupCount=self.config.backup_count)
+        return logging.FileHandler(self.log_file)
+
+    # Writes the queued records, stops the background listener and closes the log file
+    def shutdown(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.handlers = []
 
     # returns the initialized logger
     def get_logger(self):
-        return self.logger
\ No newline at end of file
+        return self.logger
+
+
+# Logs the messages sent to the queue according to the message_log mode:
+# 'all' logs a line per message, 'sample' logs every n-th message and 'summary' only logs the counts.
+# Sample and summary modes log the counts per kind when the cycle is flushed
+class SentMessageLog:
+    def __init__(self, logger, mode='all', sample_every=100):
+        self.__logger = logger
+        self.__mode = mode
+        self.__sample_every = sample_every
+        self.__counts = Counter()
+        self.__total = 0
+
+    # Records a sent message of the given kind
+    def sent(self, kind, label):
+        self.__counts[kind] += 1
+        self.__total += 1
+        if self.__mode == 'all' or (self.__mode == 'sample' and (self.__total - 1) % self.__sample_every == 0):
+            self.__logger.info(f"Sent {kind} to queue: {label}", stacklevel=2)
+
+    # Logs the counts of the cycle and starts counting again
+    def flush(self):
+        if self.__total and self.__mode != 'all':
+            counts = ', '.join(f"{count} {kind}(s)" for kind, count in sorted(self.__counts.items()))
+            self.__logger.info(f"Sent {counts} to queue", stacklevel=2)
+        self.__counts.clear()
+        self.__total = 0
@@ -0,0 +1,154 @@
+import cProfile, json, os, pstats, threading, time
+from contextlib import contextmanager
+
+from src.utils.file_utils import write_atomic
+
+_PROMETHEUS_PREFIX = 'mantis_notification_'
+
+
+# Builds the registry key of a metric with its labels, e.g. stage_seconds{stage="extract"}
+def _metric_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in sorted(labels.items())) + '}'
+
+
+# Thread safe registry of the counters and timers of a cycle.
+# Counters add up values such as issues, notes, attachments and bytes; timers keep the count,
+# total and maximum seconds of a stage or external call. Both take optional labels.
+# The registry is reset at the start of every cycle and exported as a Prometheus textfile or JSON summary
+# once the cycle is done. When profiling is enabled the hot loops wrapped in profiled() are profiled as well
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__timers = {}
+        self.__profile_dir = None
+        self.__profiles = {}
+        self.__profiling = threading.Lock()
+        self.__started_at = time.time()
+
+    # Clears all values, done at the start of every cycle
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__timers.clear()
+            self.__profiles.clear()
+            self.__started_at = time.time()
+
+    # Adds the value to a counter
+    def increment(self, name, value=1, **labels):
+        key = _metric_key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    # Counts an error of the given stage
+    def error(self, stage):
+        self.increment('errors_total', stage=stage)
+
+    # Records the duration of one stage run or external call
+    def observe(self, name, seconds, **labels):
+        key = _metric_key(name, labels)
+        with self.__lock:
+            count, total, maximum = self.__timers.get(key, (0, 0.0, 0.0))
+            self.__timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    # Times the enclosed block, the duration is recorded even when the block raises
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Turns profiling of the hot loops on, profiles are written to the folder on export.
+    # None turns it off again
+    def enable_profiling(self, profile_dir):
+        self.__profile_dir = profile_dir
+
+    # Profiles the enclosed block under the given name when profiling is enabled.
+    # Works on Python 3.8 and later. From Python 3.12 only one profiler can be active in the whole process,
+    # so one block is profiled at a time: a block which starts while another block of any thread is profiled,
+    # including a nested block, runs unprofiled, as does a block started while another profiling tool is active.
+    # The profiles of a name therefore sample its runs. Profiles of the same name are merged into one file
+    @contextmanager
+    def profiled(self, name):
+        if self.__profile_dir is None or not self.__profiling.acquire(blocking=False):
+            yield
+            return
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool, e.g. a debugger or coverage, is active on Python 3.12+
+                profile = None
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    with self.__lock:
+                        self.__profiles.setdefault(name, []).append(profile)
+        finally:
+            self.__profiling.release()
+
+    # Returns the current values as a dictionary
+    def snapshot(self):
+        with self.__lock:
+            return {
+                'started_at': self.__started_at,
+                'duration_seconds': time.time() - self.__started_at,
+                'counters': dict(self.__counters),
+                'timers': {key: {'count': count, 'sum': total, 'max': maximum}
+                           for key, (count, total, maximum) in self.__timers.items()},
+            }
+
+    # Formats the values in the Prometheus text exposition format, all values are gauges of the last cycle
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        families = {}
+        for key, value in snapshot['counters'].items():
+            families.setdefault(key.partition('{')[0], []).append((key, value))
+        for key, timer in snapshot['timers'].items():
+            name, brace, labels = key.partition('{')
+            for field in ('count', 'sum', 'max'):
+                families.setdefault(f"{name}_{field}", []).append((f"{name}_{field}{brace}{labels}", timer[field]))
+        families['cycle_duration_seconds'] = [('cycle_duration_seconds', snapshot['duration_seconds'])]
+        lines = []
+        for name in sorted(families):
+            lines.append(f"# TYPE {_PROMETHEUS_PREFIX}{name} gauge")
+            lines.extend(f"{_PROMETHEUS_PREFIX}{key} {value}" for key, value in sorted(families[name]))
+        return '\n'.join(lines) + '\n'
+
+    # Formats the values as a JSON summary
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4, sort_keys=True)
+
+    # Writes the values to the file in the 'prometheus' or 'json' format and dumps the collected profiles
+    def export(self, file_path, export_format='json'):
+        if export_format == 'prometheus':
+            write_atomic(file_path, self.to_prometheus())
+        elif export_format == 'json':
+            write_atomic(file_path, self.to_json())
+        else:
+            raise ValueError(f"Unsupported metrics format '{export_format}', expected 'prometheus' or 'json'")
+        self.__dump_profiles()
+
+    # Writes one merged pstats file per profiled name
+    def __dump_profiles(self):
+        if self.__profile_dir is None:
+            return
+        with self.__lock:
+            profiles, self.__profiles = self.__profiles, {}
+        os.makedirs(self.__profile_dir, exist_ok=True)
+        for name, name_profiles in profiles.items():
+            stats = pstats.Stats(name_profiles[0])
+            for profile in name_profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(self.__profile_dir, f"{name}.prof"))
+
+
+# Registry shared by the handlers of the process, every shard process has its own
+metrics = Metrics()
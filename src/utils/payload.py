@@ -0,0 +1,74 @@
+import base64, gzip, hashlib, json
+
+_ISSUE_PREFIX = 'Issue '
+
+
+# Groups the records of a batch by issue in the order the issues first appear
+def group_records(records):
+    groups = {}
+    for record in records:
+        groups.setdefault(record.issue_id, []).append(record)
+    return list(groups.values())
+
+
+# Yields batches of the records of at most size issues from a record stream, records arrive from the stream
+# in issue order, so the records of an issue are never split across batches and become one grouped message
+def batched_by_issue(records, size):
+    batch = []
+    issues = 0
+    for record in records:
+        if not batch or batch[-1].issue_id != record.issue_id:
+            if issues >= size:
+                yield batch
+                batch, issues = [], 0
+            issues += 1
+        batch.append(record)
+    if batch:
+        yield batch
+
+
+# Builds the data of one grouped message: the issue fields are stored once and the work notes
+# only keep their own fields
+def build_group_data(records):
+    data = {}
+    notes = []
+    for record in records:
+        issue_fields = {key: value for key, value in record.data.items() if key.startswith(_ISSUE_PREFIX)}
+        data.update(issue_fields)
+        if record.kind == 'note':
+            notes.append({key: value for key, value in record.data.items() if not key.startswith(_ISSUE_PREFIX)})
+    data['Work Notes'] = notes
+    return data
+
+
+# Idempotency key of a grouped message, derived from the keys of its records
+def group_key(records):
+    digest = hashlib.sha1('|'.join(record.key for record in records).encode('utf-8')).hexdigest()
+    return f"group:{records[0].issue_id}:{digest}"
+
+
+# Serializes message data in the configured payload format.
+# The legacy format is indented JSON, the compact and grouped formats use compact JSON.
+# Bodies longer than the compression threshold are gzip compressed and sent base64 encoded in an envelope
+# {"content_encoding": "gzip", "data": "..."}, a threshold of 0 turns compression off
+class PayloadEncoder:
+    def __init__(self, payload_format='legacy', compress_threshold=0):
+        self.__format = payload_format
+        self.__compress_threshold = compress_threshold
+        self.compressed = 0
+
+    @property
+    def grouped(self):
+        return self.__format == 'grouped'
+
+    # Returns the message body of the data
+    def encode(self, data):
+        if self.__format == 'legacy':
+            body = json.dumps(data, indent=4)
+        else:
+            body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        if self.__compress_threshold and len(body) > self.__compress_threshold:
+            self.compressed += 1
+            content = base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('ascii')
+            body = json.dumps({'content_encoding': 'gzip', 'data': content}, separators=(',', ':'))
+        return body
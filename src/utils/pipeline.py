@@ -0,0 +1,134 @@
+import queue, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+# Wraps an exception raised by a producer so it can be re-raised in the consumer
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+# Puts the item into the bounded buffer, waiting for space until the stop event is set.
+# Returns False when the item was not put because of the stop event
+def _put_until_stopped(buffer, stop_event, item):
+    while not stop_event.is_set():
+        try:
+            buffer.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Runs the iterable in a background thread and yields its items through a buffer of at most maxsize items.
+# The producer blocks while the buffer is full, so a slow consumer applies backpressure to it.
+# Errors of the producer are re-raised in the consumer, and closing the generator stops the producer
+def bounded_prefetch(iterable, maxsize):
+    buffer = queue.Queue(maxsize)
+    stop_event = threading.Event()
+
+    def put(item):
+        return _put_until_stopped(buffer, stop_event, item)
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            # Closes an unfinished generator in the producer thread which was running it
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, name='pipeline-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+# Marker yielded by bounded_interleave once the generator of an item is exhausted
+CHUNK_DONE = object()
+
+
+# Marker yielded by bounded_interleave when the generator of an item raised an error
+class ChunkFailed:
+    def __init__(self, error):
+        self.error = error
+
+
+# Runs the generator func(item) of every item on a thread pool, at most max_workers at a time, and yields
+# (item, value) pairs through a buffer of at most maxsize pairs as they are produced. Every item ends with
+# (item, CHUNK_DONE), or (item, ChunkFailed) when its generator raised, so one failing item never stops the others
+def bounded_interleave(func, items, max_workers, maxsize):
+    buffer = queue.Queue(maxsize)
+    stop_event = threading.Event()
+
+    def run(item):
+        values = None
+        try:
+            values = func(item)
+            for value in values:
+                if not _put_until_stopped(buffer, stop_event, (item, value)):
+                    return
+            _put_until_stopped(buffer, stop_event, (item, CHUNK_DONE))
+        except Exception as e:
+            _put_until_stopped(buffer, stop_event, (item, ChunkFailed(e)))
+        finally:
+            if hasattr(values, 'close'):
+                values.close()
+
+    items = list(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline-interleave')
+    for item in items:
+        executor.submit(run, item)
+    remaining = len(items)
+    try:
+        while remaining:
+            item, value = buffer.get()
+            if value is CHUNK_DONE or isinstance(value, ChunkFailed):
+                remaining -= 1
+            yield item, value
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Applies func to the items on a thread pool and yields the results in the order of the items.
+# At most max_pending calls are in flight or waiting to be consumed, so memory stays bounded
+def bounded_map(func, items, max_workers, max_pending):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Groups the items of an iterable into lists of at most size items
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,20 @@
+import threading, time
+
+
+# Thread safe rate limiter spacing calls evenly at the given rate per second. A rate of 0 disables limiting
+class RateLimiter:
+    def __init__(self, rate_per_second):
+        self.__interval = 1.0 / rate_per_second if rate_per_second else 0
+        self.__next_slot = time.monotonic()
+        self.__lock = threading.Lock()
+
+    # Blocks until the caller may proceed
+    def acquire(self):
+        if not self.__interval:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            slot = max(self.__next_slot, now)
+            self.__next_slot = slot + self.__interval
+        if slot > now:
+            time.sleep(slot - now)
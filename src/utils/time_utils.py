@@ -0,0 +1,14 @@
+import pytz
+from datetime import datetime
+from functools import lru_cache
+
+
+# Converts an ISO 8601 timestamp to UTC epoch seconds.
+# Timestamps with an offset are converted exactly; naive timestamps are taken to be in the given time zone.
+# Results are cached since the same timestamp is often shared by an issue and its notes
+@lru_cache(maxsize=8192)
+def to_epoch(timestamp, time_zone='UTC'):
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is None:
+        parsed = pytz.timezone(time_zone).localize(parsed)
+    return int(parsed.timestamp())
@@ -0,0 +1,72 @@
+import pytest
+
+from src.handlers import coalescing_handler
+from src.handlers.coalescing_handler import CoalescingHandler
+from src.handlers.mantis_handler import NotificationRecord
+
+
+def note(text, updated_at):
+    return NotificationRecord('note', 1, 9, updated_at, {'Work Note text': text})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(coalescing_handler.time, 'time', lambda: now[0])
+    return now
+
+
+def cycle(coalescer, records):
+    result = list(coalescer.coalesce(records))
+    coalescer.mark_sent(result)
+    return [record.data['Work Note text'] for record in result]
+
+
+def test_unchanged_record_is_dropped(tmp_path, clock):
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db')
+    assert cycle(coalescer, [note('a', 't1')]) == ['a']
+    assert cycle(coalescer, [note('a', 't2')]) == []
+    assert coalescer.dropped == 1
+
+
+def test_changes_within_the_debounce_interval_are_held_and_merged(tmp_path, clock):
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db', debounce_seconds=60)
+    assert cycle(coalescer, [note('a', 't1')]) == ['a']
+    clock[0] += 10
+    assert cycle(coalescer, [note('b', 't2')]) == []
+    clock[0] += 10
+    assert cycle(coalescer, [note('c', 't3')]) == []
+    assert coalescer.held == 1
+    # Released once the interval after the last send has passed, as the latest version only
+    clock[0] += 50
+    assert cycle(coalescer, []) == ['c']
+    assert cycle(coalescer, []) == []
+
+
+def test_held_record_is_released_again_when_it_was_not_sent(tmp_path, clock):
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db', debounce_seconds=60)
+    cycle(coalescer, [note('a', 't1')])
+    list(coalescer.coalesce([note('b', 't2')]))
+    clock[0] += 60
+    # The cycle which released the held version failed before it was sent
+    assert [record.updated_at for record in coalescer.coalesce([])] == ['t2']
+    assert cycle(coalescer, []) == ['b']
+
+
+def test_held_version_reverted_to_the_sent_one_is_dropped(tmp_path, clock):
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db', debounce_seconds=60)
+    cycle(coalescer, [note('a', 't1')])
+    assert cycle(coalescer, [note('b', 't2')]) == []
+    assert cycle(coalescer, [note('a', 't3')]) == []
+    clock[0] += 60
+    assert cycle(coalescer, []) == []
+
+
+def test_state_survives_a_restart(tmp_path, clock):
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db', debounce_seconds=60)
+    cycle(coalescer, [note('a', 't1')])
+    cycle(coalescer, [note('b', 't2')])
+    coalescer.close()
+    coalescer = CoalescingHandler(tmp_path / 'coalescing.db', debounce_seconds=60)
+    clock[0] += 60
+    assert cycle(coalescer, [note('a', 't3')]) == []
@@ -0,0 +1,79 @@
+import json
+
+import requests
+
+from src.handlers.mantis_handler import count_fetch_attempts, is_transient_error, next_cursor, retry_upper_bound
+from src.utils.cursor_store import CursorStore
+
+ROWS = [{'id': 5, 'last_updated': 100}, {'id': 3, 'last_updated': 105}, {'id': 7, 'last_updated': 105},
+        {'id': 2, 'last_updated': 110}]
+NOTE_ROWS = [{'bug_id': 2, 'id': 9, 'last_modified': 103}]
+CURSOR = {'last_updated': 90, 'issue_id': 0}
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def test_next_cursor_covers_every_second_before_the_upper_bound():
+    assert next_cursor(CURSOR, ROWS, 106) == {'last_updated': 105, 'issue_id': 7}
+    assert next_cursor(CURSOR, ROWS, 120) == {'last_updated': 119, 'issue_id': 0}
+
+
+def test_next_cursor_never_moves_backwards():
+    cursor = {'last_updated': 105, 'issue_id': 3}
+    assert next_cursor(cursor, ROWS, 100) is cursor
+    assert next_cursor(cursor, [], 106) == {'last_updated': 105, 'issue_id': 3}
+
+
+def test_failed_issue_holds_the_cursor_before_its_earliest_change():
+    assert retry_upper_bound(set(), ROWS, NOTE_ROWS, 120) == 120
+    assert next_cursor(CURSOR, ROWS, retry_upper_bound({7}, ROWS, NOTE_ROWS, 120)) == \
+        {'last_updated': 104, 'issue_id': 0}
+    # The note of issue 2 changed before the issue itself
+    assert next_cursor(CURSOR, ROWS, retry_upper_bound({2}, ROWS, NOTE_ROWS, 120)) == \
+        {'last_updated': 102, 'issue_id': 0}
+
+
+def test_held_issue_is_read_again_by_the_next_cycle():
+    cursor = next_cursor(CURSOR, ROWS, retry_upper_bound({7}, ROWS, NOTE_ROWS, 120))
+    remaining = [row for row in ROWS if (row['last_updated'], row['id']) > (cursor['last_updated'],
+                                                                             cursor['issue_id'])]
+    assert [row['id'] for row in remaining] == [3, 7, 2]
+
+
+def test_only_transient_errors_are_retried():
+    assert is_transient_error(requests.Timeout())
+    assert is_transient_error(requests.ConnectionError())
+    assert is_transient_error(http_error(500))
+    assert is_transient_error(http_error(429))
+    assert not is_transient_error(http_error(403))
+    assert not is_transient_error(http_error(404))
+    assert not is_transient_error(ValueError('invalid JSON'))
+    assert not is_transient_error(requests.exceptions.JSONDecodeError('invalid JSON', '', 0))
+    assert not is_transient_error(KeyError('issues'))
+
+
+def test_fetch_attempts_are_counted_and_exhausted_issues_skipped():
+    attempts = count_fetch_attempts(CURSOR, {3}, 3)
+    assert attempts == {'3': 1}
+    attempts = count_fetch_attempts(dict(CURSOR, attempts=attempts), {3, 5}, 3)
+    assert attempts == {'3': 2, '5': 1}
+    # Issue 3 fails a third time and no longer holds the cursor, issue 7 succeeded and is forgotten
+    assert count_fetch_attempts(dict(CURSOR, attempts=attempts), {3}, 3) == {}
+
+
+def test_cursor_store_round_trip(tmp_path):
+    store = CursorStore(tmp_path / 'state' / 'cursor.json')
+    assert store.load() is None
+    store.save({'last_updated': 104, 'issue_id': 0, 'attempts': {'7': 2}})
+    assert store.load() == {'last_updated': 104, 'issue_id': 0, 'attempts': {'7': 2}}
+    assert [path.name for path in (tmp_path / 'state').iterdir()] == ['cursor.json']
+
+
+def test_cursor_store_reads_cursors_without_attempts(tmp_path):
+    path = tmp_path / 'cursor.json'
+    path.write_text(json.dumps({'last_updated': 100, 'issue_id': 5}))
+    assert CursorStore(path).load() == {'last_updated': 100, 'issue_id': 5, 'attempts': {}}
@@ -0,0 +1,87 @@
+from src.handlers.outbox_handler import OutboxHandler
+from src.handlers.sink_handler import MessageSink, SinkBatchError
+
+
+# Non-transactional sink failing on the messages with the given labels
+class FlakySink(MessageSink):
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    def send_message(self, label, body):
+        if label in self.failing:
+            raise Exception(f"cannot send {label}")
+        self.sent.append(label)
+
+
+# Sink which is unavailable, as a batch fails before anything is sent
+class DownSink(MessageSink):
+    def send_message(self, label, body):
+        raise Exception("queue unavailable")
+
+
+def messages(count):
+    return [(f"key{index}", f"label{index}", "body") for index in range(count)]
+
+
+def test_enqueue_ignores_known_keys(tmp_path):
+    outbox = OutboxHandler(tmp_path / 'outbox.db')
+    assert outbox.enqueue(messages(3)) == 3
+    assert outbox.enqueue(messages(4)) == 1
+    assert outbox.count_pending() == (4, 0)
+
+
+def test_partial_batch_failure_retries_only_the_unsent_messages(tmp_path):
+    outbox = OutboxHandler(tmp_path / 'outbox.db')
+    outbox.enqueue(messages(6))
+    sink = FlakySink({'label2'})
+    assert outbox.drain(sink, 4) == (5, 1, False)
+    assert sink.sent == ['label0', 'label1', 'label3', 'label4', 'label5']
+    assert [key for _, key, _, _ in outbox.pending(10)] == ['key2']
+    # The next cycle only retries the failed message
+    sink = FlakySink()
+    assert outbox.drain(sink, 4) == (1, 0, False)
+    assert sink.sent == ['label2']
+
+
+def test_send_batch_reports_the_messages_sent_before_a_failure():
+    sink = FlakySink({'label2'})
+    try:
+        sink.send_batch([(label, body) for _, label, body in messages(4)])
+    except SinkBatchError as e:
+        assert e.sent == 2
+    else:
+        raise AssertionError("send_batch did not fail")
+
+
+def test_drain_stops_when_a_whole_batch_fails_and_resumes_later(tmp_path):
+    outbox = OutboxHandler(tmp_path / 'outbox.db')
+    outbox.enqueue(messages(5))
+    assert outbox.drain(DownSink(), 2) == (0, 2, True)
+    assert outbox.count_pending() == (5, 0)
+    sink = FlakySink()
+    assert outbox.drain(sink, 2) == (5, 0, False)
+    assert sink.sent == [f"label{index}" for index in range(5)]
+    assert outbox.count_pending() == (0, 0)
+
+
+def test_messages_out_of_attempts_are_no_longer_drained(tmp_path):
+    outbox = OutboxHandler(tmp_path / 'outbox.db', max_attempts=2)
+    outbox.enqueue(messages(2))
+    for _ in range(2):
+        outbox.drain(FlakySink({'label0'}), 10)
+    assert outbox.count_pending() == (0, 1)
+    sink = FlakySink()
+    assert outbox.drain(sink, 10) == (0, 0, False)
+    assert sink.sent == []
+
+
+def test_known_keys_cover_messages_and_group_members(tmp_path):
+    outbox = OutboxHandler(tmp_path / 'outbox.db', retention_days=0)
+    outbox.enqueue([('group:1:abc', 'label', 'body')], [('issue:1:0:t', 'group:1:abc'), ('note:1:9:t', 'group:1:abc')])
+    outbox.enqueue([('issue:2:0:t', 'label', 'body')])
+    assert outbox.known_keys(['issue:1:0:t', 'note:1:9:t', 'issue:2:0:t', 'issue:3:0:t']) == \
+        {'issue:1:0:t', 'note:1:9:t', 'issue:2:0:t'}
+    outbox.drain(FlakySink(), 10)
+    outbox.purge_delivered()
+    assert outbox.known_keys(['issue:1:0:t', 'note:1:9:t', 'issue:2:0:t']) == set()